@@ -0,0 +1,267 @@
+#!/usr/bin/env python
+
+'''Take Photo Benchmarks.
+
+Time the capture pipeline against synthetic frames and a mocked camera.
+Each stage and frame size runs in a separate process so peak RSS is
+reported per stage. Results can be saved as a baseline and compared
+against later runs.
+'''
+
+from __future__ import print_function
+import os
+import sys
+import json
+import argparse
+import resource
+import shutil
+import subprocess
+import tempfile
+from time import time, sleep
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+SIZES = ['640x480', '1920x1080', '4056x3040']
+STAGES = ['quick', 'rotate', 'save_image', 'take_photo']
+BASELINE_FILENAME = 'benchmark_baseline.json'
+
+
+def synthetic_frame(width, height):
+    'Create a repeatable BGR test frame with gradients and noise.'
+    import numpy as np
+    x_ramp = np.linspace(0, 223, width, dtype=np.float32)
+    y_ramp = np.linspace(0, 223, height, dtype=np.float32)[:, None]
+    noise = np.random.RandomState(0).randint(0, 32, (height, width, 3))
+    frame = np.empty((height, width, 3), np.uint8)
+    frame[:, :, 0] = x_ramp
+    frame[:, :, 1] = y_ramp
+    frame[:, :, 2] = (x_ramp + y_ramp) / 2
+    frame += noise.astype(np.uint8)
+    return frame
+
+
+def _prepare_mock_capture(frame, frame_interval):
+    def mocked_video_capture(*_args):
+        'Used by mock.'
+        class MockVideoCapture():
+            'Mock cv2.VideoCapture with simulated frame latency.'
+
+            @staticmethod
+            def isOpened():
+                'is camera open?'
+                return True
+
+            @staticmethod
+            def getBackendName():
+                'get capture backend'
+                return 'mock'
+
+            @staticmethod
+            def grab():
+                'get frame'
+                sleep(frame_interval)
+                return True
+
+            @staticmethod
+            def read():
+                'get image'
+                sleep(frame_interval)
+                return True, frame.copy()
+
+            @staticmethod
+            def set(*_args):
+                'set parameter'
+                return
+
+            @staticmethod
+            def release():
+                'close camera'
+                return
+
+        return MockVideoCapture()
+    return mocked_video_capture
+
+
+def _missing_command(*_args, **_kwargs):
+    raise OSError(2, 'No such file or directory')
+
+
+def _video_port_exists(path):
+    return path.startswith('/dev/video') or os.path.isfile(path)
+
+
+def _import_take_photo():
+    sys.modules.pop('take_photo', None)
+    try:
+        import take_photo
+    except SystemExit:
+        return None
+    return take_photo
+
+
+def _run_stage(stage, frame, options):
+    if stage == 'quick':
+        def _command(*_args):
+            sleep(options.command_latency)
+            return 0
+        with mock.patch('subprocess.call', _command):
+            return _import_take_photo()
+    take_photo = sys.modules['take_photo']
+    if stage == 'rotate':
+        return take_photo.rotate(frame)
+    if stage == 'save_image':
+        return take_photo.save_image(frame)
+    with mock.patch('cv2.VideoCapture',
+                    _prepare_mock_capture(frame, options.frame_interval)):
+        return take_photo.take_photo()
+
+
+def run_stage(stage, size, options):
+    'Benchmark one stage at one frame size in the current process.'
+    import tracemalloc
+    width, height = [int(dimension) for dimension in size.split('x')]
+    images_dir = tempfile.mkdtemp()
+    os.environ.update({
+        'IMAGES_DIR': images_dir,
+        'take_photo_logging': 'quiet',
+        'take_photo_width': str(width),
+        'take_photo_height': str(height),
+        'take_photo_disable_rotation_adjustment': '0',
+        'CAMERA_CALIBRATION_total_rotation_angle': str(options.angle),
+        'camera': 'USB',
+        'take_photo_low_memory': '1' if options.low_memory else '0',
+        'take_photo_encoder': options.encoder,
+    })
+    if stage == 'quick':
+        os.environ['take_photo_disable_rotation_adjustment'] = '1'
+    else:
+        _import_take_photo().load_opencv()
+    frame = synthetic_frame(width, height)
+    patches = [
+        mock.patch('os.listdir', mock.Mock(return_value=['video0'])),
+        mock.patch('os.path.exists', _video_port_exists),
+        mock.patch('subprocess.check_output', _missing_command),
+    ]
+    for patch in patches:
+        patch.start()
+    rss_start = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    _run_stage(stage, frame, options)  # warm up
+    timings = []
+    for _ in range(options.repeat):
+        start = time()
+        _run_stage(stage, frame, options)
+        timings.append((time() - start) * 1000)
+    tracemalloc.start()
+    _run_stage(stage, frame, options)
+    allocated_peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    for patch in patches:
+        patch.stop()
+    shutil.rmtree(images_dir)
+    timings.sort()
+    take_photo = sys.modules.get('take_photo')
+    return {
+        'stage': stage,
+        'size': size,
+        'wall_ms': round(timings[len(timings) // 2], 3),
+        'wall_min_ms': round(timings[0], 3),
+        'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        'rss_growth_kb': resource.getrusage(
+            resource.RUSAGE_SELF).ru_maxrss - rss_start,
+        'allocated_peak_kb': allocated_peak // 1024,
+        'spans_ms': take_photo.METRICS['spans'] if take_photo else {},
+    }
+
+
+def run_all(stages, sizes, options):
+    'Benchmark each stage and size in a separate process.'
+    results = []
+    for stage in stages:
+        for size in sizes:
+            args = [sys.executable, os.path.abspath(__file__),
+                    '--child', '--stages', stage, '--sizes', size,
+                    '--repeat', str(options.repeat),
+                    '--angle', str(options.angle),
+                    '--frame-interval', str(options.frame_interval),
+                    '--command-latency', str(options.command_latency)]
+            if options.low_memory:
+                args.append('--low-memory')
+            args += ['--encoder', options.encoder]
+            output = subprocess.check_output(args, cwd=os.path.dirname(
+                os.path.abspath(__file__)))
+            results.append(json.loads(output.decode().strip().split('\n')[-1]))
+    return results
+
+
+def compare(results, baseline, tolerance):
+    'List results slower or larger than the baseline allows.'
+    previous = {(r['stage'], r['size']): r for r in baseline}
+    regressions = []
+    for result in results:
+        before = previous.get((result['stage'], result['size']))
+        if before is None:
+            continue
+        for key in ['wall_ms', 'allocated_peak_kb']:
+            limit = before[key] * tolerance
+            if result[key] > limit and result[key] - before[key] > 1:
+                regressions.append('{} {} {}: {} > {} (baseline {})'.format(
+                    result['stage'], result['size'], key,
+                    result[key], round(limit, 3), before[key]))
+    return regressions
+
+
+def print_results(results):
+    'Print a results table.'
+    columns = ['stage', 'size', 'wall_ms', 'wall_min_ms', 'peak_rss_kb',
+               'rss_growth_kb', 'allocated_peak_kb']
+    print(' '.join('{:>17}'.format(column) for column in columns))
+    for result in results:
+        print(' '.join('{:>17}'.format(result[column]) for column in columns))
+
+
+def main():
+    'Run benchmarks and compare with a stored baseline.'
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--stages', default=','.join(STAGES))
+    parser.add_argument('--sizes', default=','.join(SIZES))
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--angle', type=float, default=10.)
+    parser.add_argument('--frame-interval', type=float, default=1 / 30.)
+    parser.add_argument('--command-latency', type=float, default=0.)
+    parser.add_argument('--low-memory', action='store_true')
+    parser.add_argument('--encoder', default='opencv')
+    parser.add_argument('--baseline', default=BASELINE_FILENAME)
+    parser.add_argument('--save-baseline', action='store_true')
+    parser.add_argument('--tolerance', type=float, default=1.25)
+    parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+    options = parser.parse_args()
+    if options.child:
+        print(json.dumps(run_stage(options.stages, options.sizes, options)))
+        return
+    results = run_all(options.stages.split(','), options.sizes.split(','),
+                      options)
+    print_results(results)
+    if options.save_baseline:
+        with open(options.baseline, 'w') as baseline_file:
+            json.dump(results, baseline_file, indent=2)
+        print('Baseline saved to {}.'.format(options.baseline))
+        return
+    try:
+        with open(options.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+    except (IOError, OSError, ValueError):
+        print('No baseline at {}. Use --save-baseline to create one.'.format(
+            options.baseline))
+        return
+    regressions = compare(results, baseline, options.tolerance)
+    for regression in regressions:
+        print('REGRESSION: ' + regression)
+    if regressions:
+        sys.exit(1)
+    print('No regressions compared to {}.'.format(options.baseline))
+
+
+if __name__ == '__main__':
+    main()
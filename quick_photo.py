@@ -0,0 +1,372 @@
+#!/usr/bin/env python
+
+'''Take a photo quickly.
+
+Take a photo using fswebcam or raspistill without importing OpenCV.
+'''
+
+from __future__ import print_function
+import os
+import sys
+from time import time
+import subprocess
+import json
+import socket
+import threading
+import atexit
+
+
+WIDTH = os.getenv('take_photo_width', '640')
+HEIGHT = os.getenv('take_photo_height', '480')
+ARGS_JSON_STRING = os.getenv('take_photo_args', "[]")
+DAEMON_SOCKET = os.getenv('take_photo_daemon_socket')
+DAEMON_TIMEOUT = os.getenv('take_photo_daemon_timeout', '30')
+BURST_COUNT = os.getenv('take_photo_burst', '1')
+LOG_BATCH_WINDOW = os.getenv('take_photo_log_batch_window', '0.05')
+OPENCV_FALLBACK_ENABLED = '1' in os.getenv('take_photo_opencv_fallback', '0')
+INDEX_ENABLED = '1' in os.getenv('take_photo_index', '0')
+QUOTA_MB = os.getenv('take_photo_quota_mb', '0')
+PROFILE_NAME = os.getenv('take_photo_profile', 'default').lower()
+JPEG_QUALITY = os.getenv('take_photo_jpeg_quality')
+PROFILE_REPORT_ENABLED = '1' in os.getenv('take_photo_profile_report', '0')
+THUMBNAIL_WIDTHS = os.getenv('take_photo_thumbnails', '')
+ROI = os.getenv('take_photo_roi', '')
+OUTPUT_PROFILES = {
+    'default': {'format': 'jpg'},
+    'upload': {'format': 'jpg', 'quality': 75,
+               'optimize': True, 'progressive': True},
+    'scan': {'format': 'jpg', 'quality': 90},
+    'png': {'format': 'png', 'compression': 1},
+    'webp': {'format': 'webp', 'quality': 80},
+}
+CAMERA_DISABLED_MSG = 'No camera selected. Choose a camera on the device page.'
+
+
+FALLBACK = []
+TIMESTAMPS = [0]
+TIMESTAMP_LOCK = threading.Lock()
+INDEX_LOCK = threading.Lock()
+LOG_BATCH = []
+LOG_CONNECTION = []
+LOG_LOCK = threading.Lock()
+
+
+def _farmware_api_connection():
+    'Open (or reuse) the Farmware API request and response sockets.'
+    if not LOG_CONNECTION:
+        import socket
+        s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        r = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            s.connect(os.environ['FARMWARE_API_V2_REQUEST_PIPE'])
+            r.connect(os.environ['FARMWARE_API_V2_RESPONSE_PIPE'])
+        except:
+            s.close()
+            r.close()
+            raise
+        LOG_CONNECTION.extend([s, r])
+    return LOG_CONNECTION
+
+
+def _close_farmware_api_connection():
+    while LOG_CONNECTION:
+        LOG_CONNECTION.pop().close()
+
+
+def _read_farmware_api_response(r):
+    import struct
+    header = b''
+    while len(header) < 10:
+        chunk = r.recv(10 - len(header))
+        if not chunk:
+            return
+        header += chunk
+    remaining = struct.unpack('!Hii', header)[2]
+    while remaining > 0:
+        chunk = r.recv(min(remaining, 4096))
+        if not chunk:
+            return
+        remaining -= len(chunk)
+
+
+def flush_log():
+    'Send batched error messages in a single Farmware API request.'
+    with LOG_LOCK:
+        texts = LOG_BATCH[:]
+        del LOG_BATCH[:]
+        if not texts:
+            return
+        try:
+            import json, struct
+            s, r = _farmware_api_connection()
+            message = bytes(json.dumps({
+                'kind': 'rpc_request', 'args': {'label': ''},
+                'body': [{
+                    'kind': 'send_message',
+                    'args': {'message': text, 'message_type': 'error'}}
+                    for text in texts]}), 'utf-8')
+            s.sendall(struct.pack('!Hii', 0xFBFB, 0, len(message)) + message)
+            _read_farmware_api_response(r)
+        except (KeyError, TypeError):
+            for text in texts:
+                std_print(text)
+        except (IOError, OSError):
+            _close_farmware_api_connection()
+            for text in texts:
+                std_print(text)
+
+
+def _log(text):
+    with LOG_LOCK:
+        LOG_BATCH.append(text)
+        if len(LOG_BATCH) > 1:
+            return  # a flush is already scheduled
+    timer = threading.Timer(float(LOG_BATCH_WINDOW), flush_log)
+    timer.daemon = True
+    timer.start()
+
+
+def exit_quick_path():
+    'Send any batched log messages and exit.'
+    flush_log()
+    sys.exit(0)
+
+
+atexit.register(_close_farmware_api_connection)
+atexit.register(flush_log)
+
+
+try:
+    MissingError = FileNotFoundError
+except NameError:
+    MissingError = OSError
+
+
+def get_camera_selection():
+    'Fetch camera type selected.'
+    return os.getenv('camera', 'USB').upper()
+
+
+def rotation_disabled():
+    'Check if rotation is disabled via environment variable.'
+    return '1' in os.getenv('take_photo_disable_rotation_adjustment', '1')
+
+
+def daemon_enabled():
+    'Check if capture daemon mode is enabled via environment variable.'
+    return '1' in os.getenv('take_photo_daemon', '0')
+
+
+def all_cameras_enabled():
+    'Check if capture from all USB cameras is enabled via environment variable.'
+    return '1' in os.getenv('take_photo_all_cameras', '0')
+
+
+def timelapse_enabled():
+    'Check if time-lapse capture is enabled via environment variable.'
+    return float(os.getenv('take_photo_timelapse_interval', '0')) > 0
+
+
+def quick_path_enabled():
+    'Check if a photo can be taken without OpenCV.'
+    return rotation_disabled() and not opencv_required() \
+        and not timelapse_enabled()
+
+
+def opencv_required():
+    'Check if the selected options are only available with OpenCV.'
+    if daemon_enabled() or all_cameras_enabled() or int(BURST_COUNT) > 1:
+        return True
+    if THUMBNAIL_WIDTHS.strip() or ROI.strip() or PROFILE_REPORT_ENABLED:
+        return True
+    if float(QUOTA_MB) > 0:  # eviction and atomic writes
+        return True
+    profile = output_profile()
+    if profile.get('optimize') or profile.get('progressive'):
+        return True  # not available from fswebcam or raspistill
+    return profile['format'] not in ['jpg', 'png']
+
+
+def output_profile():
+    'Fetch the selected output profile.'
+    profile = dict(OUTPUT_PROFILES.get(PROFILE_NAME, OUTPUT_PROFILES['default']))
+    if JPEG_QUALITY is not None and profile['format'] == 'jpg':
+        profile['quality'] = int(JPEG_QUALITY)
+    return profile
+
+
+def std_print(text):
+    'Print.'
+    if not 'quiet' in os.getenv('take_photo_logging', '').lower():
+        try:
+            print(text, flush=True)
+        except TypeError:
+            print(text)
+
+
+def get_video_port_list():
+    'Get available video ports from /dev.'
+    return [d for d in os.listdir('/dev') if d.startswith('video')]
+
+
+def usb_camera_call(savepath):
+    'Call fswebcam.'
+    args = ['fswebcam']
+    args += json.loads(ARGS_JSON_STRING)
+    size = '{}x{}'.format(WIDTH, HEIGHT)
+    args += ['-r', size, '-S', '10', '--no-banner']
+    profile = output_profile()
+    if profile['format'] == 'png':
+        args += ['--png', str(profile['compression'])]
+    elif 'quality' in profile:
+        args += ['--jpeg', str(profile['quality'])]
+    args += [savepath]
+    std_print('Calling `{}`...'.format(' '.join(args)))
+    try:
+        return subprocess.call(args)
+    except MissingError:
+        return 1
+
+
+def rpi_photo_args(savepath):
+    'Prepare raspistill arguments.'
+    width = min(int(WIDTH), 4056)
+    height = min(int(HEIGHT), 3040)
+    size = ['-w', str(width), '-h', str(height)]
+    if height > 1500:
+        size = ['-md', '3']
+    encoding = []
+    profile = output_profile()
+    if profile['format'] == 'png':
+        encoding = ['-e', 'png']
+    elif 'quality' in profile:
+        encoding = ['-q', str(profile['quality'])]
+    return ['raspistill'] + size + encoding + ['-o', savepath]
+
+
+def rpi_photo_call(savepath):
+    'Call raspistill.'
+    args = rpi_photo_args(savepath)
+    std_print('Calling `{}`...'.format(' '.join(args)))
+    try:
+        return subprocess.call(args)
+    except MissingError:
+        return 1
+
+
+def daemon_photo(socket_path, command='photo'):
+    'Send a request to a running capture daemon.'
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    client.settimeout(float(DAEMON_TIMEOUT))
+    response = b''
+    try:
+        client.connect(socket_path)
+        client.sendall(command.encode() + b'\n')
+        while not response.endswith(b'\n'):
+            chunk = client.recv(1024)
+            if not chunk:
+                break
+            response += chunk
+    except socket.error:  # includes socket.timeout
+        return None
+    finally:
+        client.close()
+    return response.decode().strip()
+
+
+def unique_timestamp():
+    'Millisecond timestamp that increases with every call.'
+    with TIMESTAMP_LOCK:
+        timestamp = max(int(time() * 1000), TIMESTAMPS[0] + 1)
+        TIMESTAMPS[0] = timestamp
+    return timestamp
+
+
+def cache_path(filename, images_dir):
+    'Filename with path for a cache file kept next to an images directory.'
+    images_dir = os.path.abspath(images_dir or '/tmp/images')
+    return os.path.join(os.path.dirname(images_dir), '.take_photo_' + filename)
+
+
+def file_size(path):
+    'Size of a file in bytes, or None if missing.'
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return None
+
+
+def append_index(record):
+    'Add a capture record to the index if enabled via environment variable.'
+    if not INDEX_ENABLED:
+        return
+    line = json.dumps(record, sort_keys=True) + '\n'
+    path = cache_path('index.jsonl', os.path.dirname(record['file']))
+    try:
+        with INDEX_LOCK:
+            with open(path, 'a') as f:
+                f.write(line)
+    except (IOError, OSError):
+        std_print('Unable to write capture index.')
+
+
+def quick_photo():
+    'Take a photo without OpenCV. Return True if done, False if not possible.'
+    # Hands off to a running capture daemon if one was specified.
+    if DAEMON_SOCKET and not daemon_enabled():
+        saved_path = daemon_photo(DAEMON_SOCKET)
+        if saved_path:
+            std_print('Image saved by capture daemon: {}'.format(saved_path))
+            return True
+        elif saved_path is not None:
+            _log('Capture daemon could not get an image.')
+            return True
+        std_print('Capture daemon not available. Taking photo directly...')
+    if not quick_path_enabled():
+        return False
+    savepath = '/tmp/images/{}.{}'.format(
+        unique_timestamp(),
+        'png' if output_profile()['format'] == 'png' else 'jpg')
+    selected_camera = get_camera_selection()
+    if 'NONE' in selected_camera:
+        _log(CAMERA_DISABLED_MSG)
+        return True
+    start = time()
+    if 'RPI' in selected_camera:
+        return_code = rpi_photo_call(savepath)
+    else:
+        if len(get_video_port_list()) < 1:
+            _log('USB Camera not detected.')
+            return True
+        return_code = usb_camera_call(savepath)
+    if return_code != 0:
+        return False
+    append_index({
+        'file': savepath, 'time': time(), 'camera': selected_camera,
+        'port': None, 'width': int(WIDTH), 'height': int(HEIGHT),
+        'angle': None, 'bytes': file_size(savepath),
+        'spans_ms': {'capture': [round((time() - start) * 1000, 3)]}})
+    return True
+
+
+def main():
+    'Take a photo, falling back to OpenCV only if enabled.'
+    if quick_photo():
+        exit_quick_path()
+    if not OPENCV_FALLBACK_ENABLED:
+        if quick_path_enabled():
+            _log('Image capture error.')
+        else:
+            _log('Selected options require OpenCV. '
+                 'Set take_photo_opencv_fallback to 1 to use it.')
+        exit_quick_path()
+    std_print('Trying OpenCV...')
+    # take_photo checks this module to skip a second quick photo attempt
+    sys.modules.setdefault('quick_photo', sys.modules[__name__])
+    FALLBACK.append(True)
+    import take_photo
+    take_photo.take_photo()
+
+
+if __name__ == '__main__':
+    main()
@@ -8,125 +8,95 @@ Take a photo using a USB or Raspberry Pi camera.
 from __future__ import print_function
 import os
 import sys
-from time import time, sleep
+from time import time, sleep, localtime
+try:
+    from time import monotonic
+except ImportError:
+    monotonic = time
 import subprocess
 import json
-
-
-WIDTH = os.getenv('take_photo_width', '640')
-HEIGHT = os.getenv('take_photo_height', '480')
-ARGS_JSON_STRING = os.getenv('take_photo_args', "[]")
-CAMERA_DISABLED_MSG = 'No camera selected. Choose a camera on the device page.'
-
-
-def _log(text):
-    try:
-        import json, socket, struct
-        s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
-        r = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
-        s.connect(os.environ['FARMWARE_API_V2_REQUEST_PIPE'])
-        r.connect(os.environ['FARMWARE_API_V2_RESPONSE_PIPE'])
-        message = bytes(json.dumps({
-            'kind': 'rpc_request', 'args': {'label': ''},
-            'body': [{
-                'kind': 'send_message',
-                'args': {'message': text, 'message_type': 'error'}}]}), 'utf-8')
-        s.sendall(struct.pack('!Hii', 0xFBFB, 0, len(message)) + message)
-        r.recv(10)
-    except (KeyError, TypeError):
-        std_print(text)
-    finally:
-        s.close()
-        r.close()
-
-
+import socket
+import threading
+import atexit
+import collections
 try:
-    MissingError = FileNotFoundError
-except NameError:
-    MissingError = OSError
-
-
-def get_camera_selection():
-    'Fetch camera type selected.'
-    return os.getenv('camera', 'USB').upper()
-
-
-def rotation_disabled():
-    'Check if rotation is disabled via environment variable.'
-    return '1' in os.getenv('take_photo_disable_rotation_adjustment', '1')
-
-
-def std_print(text):
-    'Print.'
-    if not 'quiet' in os.getenv('take_photo_logging', '').lower():
-        try:
-            print(text, flush=True)
-        except TypeError:
-            print(text)
+    import queue
+except ImportError:
+    import Queue as queue
+from quick_photo import (
+    WIDTH, HEIGHT, DAEMON_SOCKET, DAEMON_TIMEOUT, BURST_COUNT, PROFILE_NAME,
+    PROFILE_REPORT_ENABLED, THUMBNAIL_WIDTHS, ROI, OUTPUT_PROFILES,
+    INDEX_ENABLED, QUOTA_MB, CAMERA_DISABLED_MSG, FALLBACK, MissingError,
+    exit_quick_path, get_camera_selection, rotation_disabled, daemon_enabled,
+    all_cameras_enabled, timelapse_enabled, quick_path_enabled,
+    opencv_required, output_profile, std_print, get_video_port_list,
+    rpi_photo_args, unique_timestamp, file_size, cache_path, append_index,
+    quick_photo)
+
+
+BURST_INTERVAL = os.getenv('take_photo_burst_interval', '0')
+SAVE_WORKERS = os.getenv('take_photo_save_workers', '0')
+SAVE_QUEUE_SIZE = os.getenv('take_photo_save_queue_size', '4')
+ROTATION_CACHE_ENABLED = '1' in os.getenv('take_photo_rotation_cache', '0')
+LOSSLESS_ROTATION = '1' in os.getenv('take_photo_lossless_rotation', '0')
+QUARTER_TURN_TOLERANCE = 0.05  # degrees
+DISCOVERY_CACHE_ENABLED = '1' in os.getenv('take_photo_discovery_cache', '0')
+SETTLE_MODE = os.getenv('take_photo_settle', 'fixed').lower()
+SETTLE_MAX_FRAMES = os.getenv('take_photo_settle_max_frames', '30')
+LOG_QUEUE_SIZE = os.getenv('take_photo_log_queue_size', '100')
+MAX_CAMERA_SKEW = os.getenv('take_photo_max_camera_skew', '0.05')
+MJPEG_ENABLED = '1' in os.getenv('take_photo_mjpeg', '0')
+LOW_MEMORY = '1' in os.getenv('take_photo_low_memory', '0')
+BEST_OF = os.getenv('take_photo_best_of', '1')
+ENCODER_NAME = os.getenv('take_photo_encoder', 'opencv').lower()
+QUOTA_KEEP_EVERY = os.getenv('take_photo_quota_keep_every', '1')
+TIMELAPSE_INTERVAL = os.getenv('take_photo_timelapse_interval', '0')
+TIMELAPSE_COUNT = os.getenv('take_photo_timelapse_count', '0')
+TIMELAPSE_END = os.getenv('take_photo_timelapse_end')
+TIMELAPSE_WINDOW = os.getenv('take_photo_timelapse_window')
+
+
+# Takes photo and exits if possible without OpenCV.
+# Without imports, logs, or processing, this is a much quicker path.
+if not FALLBACK:
+    if quick_photo():
+        exit_quick_path()
+    elif quick_path_enabled():
+        std_print('command not found. Trying OpenCV...')
 
 
-def get_video_port_list():
-    'Get available video ports from /dev.'
-    return [d for d in os.listdir('/dev') if d.startswith('video')]
+# start timer
+START_TIME = time()
 
+import importlib
+from contextlib import contextmanager
 
-def usb_camera_call(savepath):
-    'Call fswebcam.'
-    args = ['fswebcam']
-    args += json.loads(ARGS_JSON_STRING)
-    size = '{}x{}'.format(WIDTH, HEIGHT)
-    args += ['-r', size, '-S', '10', '--no-banner', savepath]
-    std_print('Calling `{}`...'.format(' '.join(args)))
-    try:
-        return subprocess.call(args)
-    except MissingError:
-        return 1
+IMPORT_TIMES = {}
 
 
-def rpi_photo_call(savepath):
-    'Call raspistill.'
-    width = min(int(WIDTH), 4056)
-    height = min(int(HEIGHT), 3040)
-    size = ['-w', str(width), '-h', str(height)]
-    if height > 1500:
-        size = ['-md', '3']
-    args = ['raspistill'] + size + ['-o', savepath]
-    std_print('Calling `{}`...'.format(' '.join(args)))
-    try:
-        return subprocess.call(args)
-    except MissingError:
-        return 1
+def import_module(name):
+    'Import a module, recording the time taken in milliseconds.'
+    if sys.modules.get(name) is not None:
+        return sys.modules[name]
+    start = time()
+    module = importlib.import_module(name)
+    IMPORT_TIMES[name] = round((time() - start) * 1000, 1)
+    return module
 
 
-# Takes photo and exits if rotation was disabled via environment variable.
-# Without imports, logs, or processing, this is a much quicker path.
-if rotation_disabled():
-    SAVEPATH = '/tmp/images/{}.jpg'.format(int(time()))
-    SELECTED_CAMERA = get_camera_selection()
-    return_code = 0
-    if 'NONE' in SELECTED_CAMERA:
-        _log(CAMERA_DISABLED_MSG)
-    elif 'RPI' in SELECTED_CAMERA:
-        return_code = rpi_photo_call(SAVEPATH)
-    else:
-        ports = get_video_port_list()
-        if len(ports) < 1:
-            _log('USB Camera not detected.')
-            sys.exit(0)
-        return_code = usb_camera_call(SAVEPATH)
-    if return_code == 0:
-        sys.exit(0)
-    else:
-        std_print('command not found. Trying OpenCV...')
+class LazyModule(object):
+    'Module that is imported when first used.'
 
+    def __init__(self, name):
+        self._name = name
 
-# start timer
-START_TIME = time()
+    def __getattr__(self, attribute):
+        return getattr(import_module(self._name), attribute)
 
-import requests
-import numpy as np
 
-FIRST_IMPORTS_COMPLETE_TIME = time()
+requests = LazyModule('requests')
+np = LazyModule('numpy')
+cv2 = LazyModule('cv2')
 
 
 def verbose_log(text, time_override=None):
@@ -141,10 +111,154 @@ def verbose_log(text, time_override=None):
         std_print(timed_log)
         return
     log_content = timed_log if 'timed' in log_level else text
+    LOG_DISPATCHER.put(log_content, 'debug')
+
+
+class LogDispatcher(object):
+    'Send log messages on a background thread so callers never wait.'
+
+    def __init__(self, queue_size):
+        self.messages = collections.deque(maxlen=queue_size)
+        self.condition = threading.Condition()
+        self.sending = False
+        self.dropped = 0
+        self.thread = None
+
+    def put(self, message, message_type):
+        'Queue a log message, dropping the oldest message if full.'
+        with self.condition:
+            if len(self.messages) == self.messages.maxlen:
+                self.dropped += 1
+            self.messages.append((message, message_type))
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._send_messages)
+                self.thread.daemon = True
+                self.thread.start()
+            self.condition.notify_all()
+
+    def _send_messages(self):
+        while True:
+            with self.condition:
+                while not self.messages:
+                    self.sending = False
+                    self.condition.notify_all()
+                    self.condition.wait()
+                message = self.messages.popleft()
+                self.sending = True
+            try:
+                send_log(*message)
+            except Exception:
+                pass
+
+    def flush(self, timeout=5):
+        'Wait for queued log messages to be sent, giving up after a timeout.'
+        deadline = time() + timeout
+        with self.condition:
+            while (self.messages or self.sending) and time() < deadline:
+                self.condition.wait(0.1)
+            stalled = bool(self.messages or self.sending)
+            dropped, self.dropped = self.dropped + len(self.messages), 0
+            self.messages.clear()
+        if stalled:
+            std_print('Log connection stalled. {} debug log messages '
+                      'dropped.'.format(dropped))
+        elif dropped:
+            send_log('{} debug log messages dropped.'.format(dropped), 'debug')
+
+
+LOG_DISPATCHER = LogDispatcher(int(LOG_QUEUE_SIZE))
+atexit.register(LOG_DISPATCHER.flush)
+
+
+METRICS = {'spans': {}, 'counts': {}, 'profiles': {}}
+METRICS_LOCK = threading.Lock()
+CAPTURE_SPANS = threading.local()
+
+
+@contextmanager
+def timed(stage):
+    'Record the duration of a stage in milliseconds.'
+    start = time()
     try:
-        log(log_content, 'debug')
-    except NameError:
-        pass
+        yield
+    finally:
+        record(stage, time() - start)
+
+
+def record(stage, seconds):
+    'Add a duration in seconds to a metrics span in milliseconds.'
+    milliseconds = round(seconds * 1000, 3)
+    capture_spans = getattr(CAPTURE_SPANS, 'spans', None)
+    with METRICS_LOCK:
+        METRICS['spans'].setdefault(stage, []).append(milliseconds)
+        if capture_spans is not None:
+            capture_spans.setdefault(stage, []).append(milliseconds)
+
+
+@contextmanager
+def capture_timings(spans=None):
+    'Collect the spans of one capture and add them to its index records.'
+    CAPTURE_SPANS.spans = {} if spans is None else spans
+    CAPTURE_SPANS.records = []
+    try:
+        yield
+    finally:
+        spans, records = CAPTURE_SPANS.spans, CAPTURE_SPANS.records
+        CAPTURE_SPANS.spans = CAPTURE_SPANS.records = None
+        for index_record in records:
+            with METRICS_LOCK:
+                index_record['spans_ms'] = dict(
+                    (stage, list(durations))
+                    for stage, durations in spans.items())
+            append_index(index_record)
+
+
+def count(name, amount=1):
+    'Add to a metrics counter.'
+    with METRICS_LOCK:
+        METRICS['counts'][name] = METRICS['counts'].get(name, 0) + amount
+
+
+def peak_rss_kb():
+    'Peak resident memory of this process in KB, if available.'
+    try:
+        import resource
+    except ImportError:
+        return None
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def write_metrics():
+    'Write collected metrics as a JSON line if enabled via environment variable.'
+    destination = os.getenv('take_photo_metrics')
+    if not destination:
+        return
+    with METRICS_LOCK:
+        line = json.dumps({
+            'start': START_TIME,
+            'camera': get_camera_selection(),
+            'size': [int(WIDTH), int(HEIGHT)],
+            'imports_ms': IMPORT_TIMES,
+            'spans_ms': METRICS['spans'],
+            'counts': METRICS['counts'],
+            'profiles': METRICS['profiles'],
+            'peak_rss_kb': peak_rss_kb(),
+        }, sort_keys=True)
+    if destination == 'stdout':
+        print(line)
+        return
+    try:
+        with open(destination, 'a') as metrics_file:
+            metrics_file.write(line + '\n')
+    except (IOError, OSError):
+        verbose_log('Unable to write metrics to {}.'.format(destination))
+
+
+def write_capture_metrics():
+    'Write a metrics line per capture in long-running modes and reset spans.'
+    write_metrics()
+    with METRICS_LOCK:
+        METRICS['spans'].clear()
 
 
 def _farmware_api_url():
@@ -153,6 +267,17 @@ def _farmware_api_url():
     return base_url + 'api/v1/' if major_version > 5 else base_url
 
 
+HTTP_SESSION = []
+
+
+def http_session():
+    'Reuse one keep-alive HTTP session for Farmware API requests.'
+    if not HTTP_SESSION:
+        HTTP_SESSION.append(requests.Session())
+        atexit.register(HTTP_SESSION[0].close)
+    return HTTP_SESSION[0]
+
+
 def legacy_log(message, message_type):
     'Send a message to the log.'
     try:
@@ -167,8 +292,8 @@ def legacy_log(message, message_type):
         payload = {
             'kind': 'send_message',
             'args': {'message': log_message, 'message_type': message_type}}
-        requests.post(_farmware_api_url() + 'celery_script',
-                      json=payload, headers=headers)
+        http_session().post(_farmware_api_url() + 'celery_script',
+                            json=payload, headers=headers)
 
 
 try:
@@ -177,52 +302,218 @@ try:
     from farmware_tools import env, device
 except ImportError:
     ft_import_result_msg = 'farmware_tools import error. Using legacy logger.'
-    log = legacy_log
+    send_log = legacy_log
     IMAGES_DIR = os.getenv('IMAGES_DIR')
 else:
     ft_import_result_msg = 'Farmware Tools import complete.'
+    IMPORT_TIMES['farmware_tools'] = round((time() - FT_IMPORT_START_TIME) * 1000, 1)
     IMAGES_DIR = env.Env().images_dir
 
-    def log(message, message_type):
+    def send_log(message, message_type):
         'Send a log message.'
         device.log('[take-photo] {}'.format(message), message_type)
 
 
-verbose_log('First imports complete.', FIRST_IMPORTS_COMPLETE_TIME)
+def log(message, message_type):
+    'Send a log message after any queued debug messages.'
+    LOG_DISPATCHER.flush()
+    send_log(message, message_type)
+
+
 verbose_log(ft_import_start_msg, FT_IMPORT_START_TIME)
 verbose_log(ft_import_result_msg)
 
-try:
-    verbose_log('Importing OpenCV...')
-    os.environ['OPENCV_VIDEOIO_DEBUG'] = '1'
-    import cv2
-except ImportError:
-    log('OpenCV import error.', 'error')
-    sys.exit(0)
-else:
-    verbose_log('OpenCV import complete.')
 
+@timed('load_opencv')
+def load_opencv():
+    'Import OpenCV, exiting if it is not available.'
+    try:
+        verbose_log('Importing OpenCV...')
+        os.environ['OPENCV_VIDEOIO_DEBUG'] = '1'
+        import_module('cv2')
+    except ImportError:
+        log('OpenCV import error.', 'error')
+        sys.exit(0)
+    else:
+        verbose_log('OpenCV import complete.')
+    verbose_log('Import times (ms): {}'.format(
+        json.dumps(IMPORT_TIMES, sort_keys=True)))
 
-def rotate(image):
-    'Rotate image if calibration data exists.'
+
+def rotation_angle():
+    'Fetch the calibration rotation angle, or None if not rotating.'
     if rotation_disabled():
-        raise KeyError('Rotation disabled.')
-    angle = float(os.environ['CAMERA_CALIBRATION_total_rotation_angle'])
+        return None
+    try:
+        return float(os.environ['CAMERA_CALIBRATION_total_rotation_angle'])
+    except (KeyError, ValueError):
+        return None
+
+
+def region_of_interest():
+    'Fetch the output region to keep as (x, y, width, height), or None.'
+    try:
+        x, y, width, height = [int(value) for value in ROI.split(',')]
+    except ValueError:
+        return None
+    if x < 0 or y < 0 or width <= 0 or height <= 0:
+        return None
+    return x, y, width, height
+
+
+def clip_region(region, width, height):
+    'Limit a region to the bounds of an image.'
+    x, y = min(region[0], width - 1), min(region[1], height - 1)
+    return x, y, min(region[2], width - x), min(region[3], height - y)
+
+
+def crop(image, region):
+    'Crop an image to a region.'
+    if region is None:
+        return image
+    x, y, width, height = clip_region(region, image.shape[1], image.shape[0])
+    return image[y:y + height, x:x + width]
+
+
+def _quarter_turns(angle):
+    'Split an angle into quarter turns and a remaining angle.'
     sign = -1 if angle < 0 else 1
     turns, remainder = -int(angle / 90.), abs(angle) % 90  # 165 --> -1, 75
     if remainder > 45: turns -= 1 * sign  # 75 --> -1 more turn (-2 turns total)
     angle += 90 * turns                   #        -15 degrees
-    image = np.rot90(image, k=turns)
-    height, width, _ = image.shape
+    return turns, angle
+
+
+def quarter_turns_only(angle):
+    'Number of quarter turns if the rotation is only quarter turns.'
+    turns, angle = _quarter_turns(angle)
+    if abs(angle) < QUARTER_TURN_TOLERANCE:
+        return turns % 4
+    return None
+
+
+def rotation_matrix(angle, width, height):
+    'Matrix mapping output pixels to source pixels, with output size.'
+    turns, angle = _quarter_turns(angle)
+    turns %= 4
+    if turns % 2:
+        width, height = height, width
+    # source coordinates of each pixel in the quarter turned image
+    quarter_turn = np.array([
+        [[1, 0, 0], [0, 1, 0], [0, 0, 1]],
+        [[0, -1, height - 1], [1, 0, 0], [0, 0, 1]],
+        [[-1, 0, width - 1], [0, -1, height - 1], [0, 0, 1]],
+        [[0, 1, 0], [-1, 0, width - 1], [0, 0, 1]],
+    ][turns], np.float64)
     matrix = cv2.getRotationMatrix2D((int(width / 2), int(height / 2)), angle, 1)
-    return cv2.warpAffine(image, matrix, (width, height))
+    inverse = np.vstack([cv2.invertAffineTransform(matrix), [0, 0, 1]])
+    return quarter_turn.dot(inverse)[:2], (width, height)
 
 
-def image_filename():
-    'Prepare filename with timestamp.'
-    epoch = int(time())
-    filename = '{timestamp}.jpg'.format(timestamp=epoch)
-    return filename
+ROTATION_MAPS = {}
+ROTATION_MAPS_LOCK = threading.Lock()
+
+
+def _build_rotation_maps(angle, width, height):
+    matrix, (out_width, out_height) = rotation_matrix(angle, width, height)
+    x_coords, y_coords = np.meshgrid(
+        np.arange(out_width, dtype=np.float32),
+        np.arange(out_height, dtype=np.float32))
+    map_x = matrix[0, 0] * x_coords + matrix[0, 1] * y_coords + matrix[0, 2]
+    map_y = matrix[1, 0] * x_coords + matrix[1, 1] * y_coords + matrix[1, 2]
+    return cv2.convertMaps(
+        map_x.astype(np.float32), map_y.astype(np.float32), cv2.CV_16SC2)
+
+
+def rotation_maps(angle, width, height):
+    'Load or build remap lookup tables for a calibration rotation.'
+    key = (angle, width, height)
+    with ROTATION_MAPS_LOCK:
+        if key in ROTATION_MAPS:
+            return ROTATION_MAPS[key]
+        path = cache_path('rotation_maps.npz', IMAGES_DIR)
+        try:
+            with open(path, 'rb') as cache_file:
+                cached = np.load(cache_file)
+                if tuple(cached['key']) != key:
+                    raise ValueError('Calibration changed.')
+                maps = cached['map1'], cached['map2']
+            verbose_log('Loaded rotation maps from {}.'.format(path))
+        except Exception:  # missing, outdated, truncated, or corrupt
+            verbose_log('Building rotation maps...')
+            maps = _build_rotation_maps(angle, width, height)
+            temp_path = '{}.{}.tmp'.format(path, os.getpid())
+            try:
+                with open(temp_path, 'wb') as cache_file:
+                    np.savez(cache_file, key=np.array(key, np.float64),
+                             map1=maps[0], map2=maps[1])
+                os.rename(temp_path, path)
+            except (IOError, OSError):
+                verbose_log('Unable to save rotation maps to {}.'.format(path))
+        ROTATION_MAPS.clear()
+        ROTATION_MAPS[key] = maps
+        return maps
+
+
+OUTPUT_BUFFERS = threading.local()
+
+
+def output_buffer(width, height, image):
+    'Reusable output image for this thread, or None if not in low memory mode.'
+    if not LOW_MEMORY:
+        return None
+    shape = (height, width) + image.shape[2:]
+    buffer = getattr(OUTPUT_BUFFERS, 'image', None)
+    if buffer is None or buffer.shape != shape or buffer.dtype != image.dtype:
+        OUTPUT_BUFFERS.image = None  # release the previous buffer first
+        buffer = OUTPUT_BUFFERS.image = np.empty(shape, image.dtype)
+    return buffer
+
+
+@timed('rotate')
+def rotate(image):
+    'Rotate image if calibration data exists.'
+    angle = rotation_angle()
+    if angle is None:
+        raise KeyError('Rotation disabled or not calibrated.')
+    turns = quarter_turns_only(angle)
+    region = region_of_interest()
+    if turns == 0:
+        return crop(image, region)
+    height, width = image.shape[:2]
+    if turns is not None and region is None:
+        if LOW_MEMORY and turns == 2:
+            return cv2.flip(image, -1, image)  # in place
+        size = (height, width) if turns % 2 else (width, height)
+        return cv2.rotate(image, [None, cv2.ROTATE_90_COUNTERCLOCKWISE,
+                                  cv2.ROTATE_180, cv2.ROTATE_90_CLOCKWISE][turns],
+                          dst=output_buffer(size[0], size[1], image))
+    if ROTATION_CACHE_ENABLED:
+        map1, map2 = rotation_maps(angle, width, height)
+        if region is not None:
+            x, y, w, h = clip_region(region, map1.shape[1], map1.shape[0])
+            map1, map2 = map1[y:y + h, x:x + w], map2[y:y + h, x:x + w]
+        return cv2.remap(image, map1, map2, cv2.INTER_LINEAR, dst=output_buffer(
+            map1.shape[1], map1.shape[0], image))
+    matrix, size = rotation_matrix(angle, width, height)
+    if region is not None:
+        # only warp the source pixels that land in the region
+        x, y, w, h = clip_region(region, *size)
+        matrix[:, 2] += matrix[:, :2].dot([x, y])
+        size = w, h
+    return cv2.warpAffine(
+        image, matrix, size, dst=output_buffer(size[0], size[1], image),
+        flags=cv2.INTER_LINEAR | cv2.WARP_INVERSE_MAP)
+
+
+def image_filename(sequence=None, camera=None):
+    'Prepare filename with timestamp and optional sequence and camera.'
+    filename = '{timestamp}'.format(timestamp=unique_timestamp())
+    if sequence is not None:
+        filename += '_{sequence}'.format(sequence=sequence)
+    if camera is not None:
+        filename += '_camera{camera}'.format(camera=camera)
+    return filename + '.' + output_profile()['format']
 
 
 def upload_path(filename):
@@ -234,23 +525,410 @@ def upload_path(filename):
     return path
 
 
-def save_image(image):
-    'Save an image to file after attempting rotation.'
-    filename = image_filename()
+CAPTURE_DETAILS = {}
+
+
+def index_image(filename_path, size, camera=None):
+    'Record a saved image with its capture details in the capture index.'
+    if not INDEX_ENABLED:
+        return
+    width, height = size or (None, None)
+    index_record = {
+        'file': filename_path, 'time': time(),
+        'camera': get_camera_selection(),
+        'port': CAPTURE_DETAILS.get('port') if camera is None else camera,
+        'width': width, 'height': height, 'angle': rotation_angle(),
+        'bytes': file_size(filename_path), 'spans_ms': {}}
+    records = getattr(CAPTURE_SPANS, 'records', None)
+    if records is None:
+        append_index(index_record)
+    else:  # written once the capture's save spans are complete
+        records.append(index_record)
+
+
+QUOTA_INDEX = {}
+QUOTA_LOCK = threading.Lock()
+
+
+def _scan_images(images_dir):
+    files = []
+    for name in os.listdir(images_dir):
+        if name.startswith('.'):
+            continue
+        stat = os.stat(os.path.join(images_dir, name))
+        files.append([name, stat.st_size, stat.st_mtime])
+    return sorted(files, key=lambda entry: entry[2])
+
+
+def quota_index(images_dir):
+    'Load the images directory index, rescanning only if the directory changed.'
+    mtime = os.stat(images_dir).st_mtime
+    index = QUOTA_INDEX.get(images_dir)
+    if index is None:
+        try:
+            with open(cache_path('quota.json', IMAGES_DIR)) as index_file:
+                index = json.load(index_file)
+        except (IOError, OSError, ValueError):
+            index = None
+    if index is None or index.get('dir') != images_dir \
+            or index.get('mtime') != mtime:
+        verbose_log('Scanning {}...'.format(images_dir))
+        index = {'dir': images_dir, 'files': _scan_images(images_dir)}
+    if 'used' not in index:
+        index['used'] = sum(entry[1] for entry in index['files'])
+    QUOTA_INDEX.clear()
+    QUOTA_INDEX[images_dir] = index
+    return index
+
+
+def save_quota_index():
+    'Store the images directory index along with the directory mtime.'
+    with QUOTA_LOCK:
+        for index in QUOTA_INDEX.values():
+            try:
+                index['mtime'] = os.stat(index['dir']).st_mtime
+                path = cache_path('quota.json', IMAGES_DIR)
+                with open(path, 'w') as index_file:
+                    json.dump(index, index_file)
+            except (IOError, OSError):
+                verbose_log('Unable to save images directory index.')
+
+
+atexit.register(save_quota_index)
+
+
+def evict_images(index, size):
+    'Remove images until a file of the given size fits in the quota.'
+    limit = float(QUOTA_MB) * 1024 * 1024
+    if index['used'] + size <= limit:
+        return
+    keep_every = max(1, int(QUOTA_KEEP_EVERY))
+    files = index['files']
+    # Oldest first, keeping one of every keep_every images until last
+    candidates = [entry for i, entry in enumerate(files) if i % keep_every]
+    candidates += [entry for i, entry in enumerate(files) if not i % keep_every]
+    for entry in candidates:
+        if index['used'] + size <= limit:
+            break
+        try:
+            os.remove(os.path.join(index['dir'], entry[0]))
+        except OSError:
+            pass
+        files.remove(entry)
+        index['used'] -= entry[1]
+        verbose_log('Quota exceeded. Removed {}.'.format(entry[0]))
+        count('images_evicted')
+
+
+def _write_file(filename_path, data):
+    directory, name = os.path.split(filename_path)
+    temp_path = os.path.join(directory, '.{}.tmp'.format(name))
+    try:
+        with open(temp_path, 'wb') as image_file:
+            image_file.write(data)
+        os.rename(temp_path, filename_path)
+    except (IOError, OSError) as error:
+        verbose_log(error)
+        log('Image save error.', 'error')
+        try:
+            os.remove(temp_path)
+        except OSError:
+            pass
+        return False
+    return True
+
+
+def write_file(filename_path, data):
+    'Write a file atomically, removing old images first if over quota.'
+    if float(QUOTA_MB) <= 0:
+        return _write_file(filename_path, data)
+    images_dir, name = os.path.split(filename_path)
+    with QUOTA_LOCK:
+        try:
+            index = quota_index(images_dir)
+        except OSError as error:
+            verbose_log(error)
+            return _write_file(filename_path, data)
+        evict_images(index, len(data))
+        written = _write_file(filename_path, data)
+        for entry in [entry for entry in index['files'] if entry[0] == name]:
+            index['files'].remove(entry)
+            index['used'] -= entry[1]
+        if written:
+            index['files'].append([name, len(data), time()])
+            index['used'] += len(data)
+        try:  # our own writes and evictions keep the index current
+            index['mtime'] = os.stat(images_dir).st_mtime
+        except OSError:
+            pass
+    return written
+
+
+def write_image_file(filename_path, image, params):
+    'Encode an image and write it to file atomically.'
+    encoded = encode_image(image, output_profile(), params)
+    if encoded is None:
+        log('Image encode error.', 'error')
+        return False
+    return write_file(filename_path, encoded)
+
+
+ENCODER_INSTANCES = {}
+UNAVAILABLE_ENCODERS = set()
+
+
+def _turbojpeg_encode(image, profile):
+    if profile['format'] != 'jpg':
+        return None
+    turbojpeg = import_module('turbojpeg')
+    if 'turbojpeg' not in ENCODER_INSTANCES:
+        ENCODER_INSTANCES['turbojpeg'] = turbojpeg.TurboJPEG()
+    flags = turbojpeg.TJFLAG_PROGRESSIVE if profile.get('progressive') else 0
+    return ENCODER_INSTANCES['turbojpeg'].encode(
+        image, quality=profile.get('quality', 95), flags=flags)
+
+
+def _pil_encode(image, profile):
+    import io
+    pil_image = import_module('PIL.Image')
+    if image.ndim == 3:
+        image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+    if profile['format'] == 'png':
+        options = {'format': 'PNG', 'compress_level': profile['compression']}
+    elif profile['format'] == 'webp':
+        options = {'format': 'WEBP', 'quality': profile['quality']}
+    else:
+        options = {'format': 'JPEG', 'quality': profile.get('quality', 95),
+                   'optimize': profile.get('optimize', False),
+                   'progressive': profile.get('progressive', False)}
+    output = io.BytesIO()
+    pil_image.fromarray(image).save(output, **options)
+    return output.getvalue()
+
+
+ENCODERS = {'turbojpeg': _turbojpeg_encode, 'pil': _pil_encode}
+
+
+@timed('encode')
+def encode_image(image, profile, params):
+    'Encode an image with the selected encoder, falling back to OpenCV.'
+    names = ['turbojpeg', 'pil'] if ENCODER_NAME == 'auto' else [ENCODER_NAME]
+    for name in names:
+        if name not in ENCODERS or name in UNAVAILABLE_ENCODERS:
+            continue
+        try:
+            encoded = ENCODERS[name](image, profile)
+        except (ImportError, OSError, RuntimeError) as error:
+            verbose_log('{} encoder not available ({}). Using OpenCV.'.format(
+                name, error))
+            UNAVAILABLE_ENCODERS.add(name)
+            continue
+        except (KeyError, ValueError) as error:  # format not supported
+            verbose_log('{} encoder failed ({}). Using OpenCV.'.format(
+                name, error))
+            continue
+        if encoded is not None:
+            count('{}_encodes'.format(name))
+            return encoded
+    ret, encoded = cv2.imencode('.' + profile['format'], image, params)
+    return encoded if ret else None
+
+
+def encoder_params(profile):
+    'OpenCV encoder parameters for an output profile.'
+    params = []
+    if profile['format'] == 'jpg':
+        if 'quality' in profile:
+            params += [cv2.IMWRITE_JPEG_QUALITY, profile['quality']]
+        if profile.get('optimize'):
+            params += [cv2.IMWRITE_JPEG_OPTIMIZE, 1]
+        if profile.get('progressive'):
+            params += [cv2.IMWRITE_JPEG_PROGRESSIVE, 1]
+    elif profile['format'] == 'png':
+        params += [cv2.IMWRITE_PNG_COMPRESSION, profile['compression']]
+    elif profile['format'] == 'webp':
+        params += [cv2.IMWRITE_WEBP_QUALITY, profile['quality']]
+    return params
+
+
+def profile_report(image):
+    'Log encode time and output size of an image for each output profile.'
+    for name, profile in sorted(OUTPUT_PROFILES.items()):
+        start = time()
+        try:
+            encoded = encode_image(image, profile, encoder_params(profile))
+        except cv2.error:
+            encoded = None
+        duration = round((time() - start) * 1000, 3)
+        if encoded is None:
+            verbose_log('Profile {}: not supported.'.format(name))
+            continue
+        with METRICS_LOCK:
+            METRICS['profiles'][name] = {'ms': duration, 'bytes': len(encoded)}
+        verbose_log('Profile {}: {} ms, {} bytes.'.format(
+            name, duration, len(encoded)))
+
+
+def thumbnail_widths():
+    'Fetch requested thumbnail widths, largest first.'
+    widths = set()
+    for width in THUMBNAIL_WIDTHS.split(','):
+        try:
+            width = int(width)
+        except ValueError:
+            continue
+        if width > 0:
+            widths.add(width)
+    return sorted(widths, reverse=True)
+
+
+def thumbnail_path(filename_path, width):
+    'Filename with path for a thumbnail of an image.'
+    root, extension = os.path.splitext(filename_path)
+    return '{}_thumb{}{}'.format(root, width, extension)
+
+
+@timed('thumbnails')
+def write_thumbnails(image, filename_path):
+    'Write downscaled copies of an image next to it.'
+    height, width = image.shape[:2]
+    params = encoder_params(output_profile())
+    for thumbnail_width in thumbnail_widths():
+        if thumbnail_width > width:
+            continue
+        if thumbnail_width < width:
+            thumbnail_height = max(1, int(round(
+                height * thumbnail_width / float(width))))
+            # Each thumbnail is downscaled from the previous, larger one
+            image = cv2.resize(image, (thumbnail_width, thumbnail_height),
+                               interpolation=cv2.INTER_AREA)
+            height, width = image.shape[:2]
+        path = thumbnail_path(filename_path, thumbnail_width)
+        if write_image_file(path, image, params):
+            verbose_log('Thumbnail saved: {}'.format(path))
+            count('thumbnails_saved')
+
+
+def write_encoded_thumbnails(data, filename_path):
+    'Write thumbnails of encoded image data using a reduced size decode.'
+    widths = thumbnail_widths()
+    if not widths:
+        return
+    flags = cv2.IMREAD_COLOR
+    size = jpeg_size(data) if data[:2] == b'\xff\xd8' else None
+    if size is not None:
+        # JPEG DCT scaling decodes at 1/2, 1/4 or 1/8 size directly
+        for scale, flag in [(8, cv2.IMREAD_REDUCED_COLOR_8),
+                            (4, cv2.IMREAD_REDUCED_COLOR_4),
+                            (2, cv2.IMREAD_REDUCED_COLOR_2)]:
+            if size[0] // scale >= widths[0]:
+                flags = flag
+                break
+    image = cv2.imdecode(np.frombuffer(data, np.uint8), flags)
+    if image is not None:
+        write_thumbnails(image, filename_path)
+
+
+@timed('write_image')
+def _write_image(image, filename, camera=None):
+    'Write an image to file after attempting rotation.'
     # Try to rotate the image
     try:
         verbose_log('Considering rotation...')
         final_image = rotate(image)
     except:
         verbose_log('Did not rotate image.')
-        final_image = image
+        final_image = crop(image, region_of_interest())
     else:
         verbose_log('Rotated image.')
         filename = 'rotated_' + filename
     # Save the image to file
     filename_path = upload_path(filename)
-    cv2.imwrite(filename_path, final_image)
+    if PROFILE_REPORT_ENABLED:
+        profile_report(final_image)
+    params = encoder_params(output_profile())
+    if not write_image_file(filename_path, final_image, params):
+        return None
     verbose_log('Image saved: {}'.format(filename_path))
+    count('images_saved')
+    index_image(filename_path, final_image.shape[1::-1], camera)
+    write_thumbnails(final_image, filename_path)
+    return filename_path
+
+
+class SavePipeline(object):
+    'Rotate, encode, and write images on worker threads.'
+
+    def __init__(self, workers, queue_size):
+        self.queue = queue.Queue(queue_size)
+        self.threads = []
+        for _ in range(workers):
+            thread = threading.Thread(target=self._save_images)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def _save_images(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            image, filename, camera, spans = item
+            try:
+                with capture_timings(spans):
+                    _write_image(image, filename, camera)
+            except Exception as error:
+                verbose_log(error)
+                log('Image save error.', 'error')
+
+    def put(self, image, filename, camera=None):
+        'Queue an image for saving, waiting if the queue is full.'
+        if self.queue.full():
+            verbose_log('Save queue full. Waiting...')
+        spans = getattr(CAPTURE_SPANS, 'spans', None)
+        self.queue.put((image, filename, camera, spans))
+
+    def close(self):
+        'Save all queued images and stop the workers.'
+        for _ in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+
+
+SAVE_PIPELINE = []
+
+
+def get_save_pipeline():
+    'Start the image save pipeline if enabled via environment variable.'
+    if int(SAVE_WORKERS) < 1:
+        return None
+    if not SAVE_PIPELINE:
+        SAVE_PIPELINE.append(SavePipeline(
+            int(SAVE_WORKERS), int(SAVE_QUEUE_SIZE)))
+        atexit.register(close_save_pipeline)
+    return SAVE_PIPELINE[0]
+
+
+def close_save_pipeline():
+    'Wait for queued images to be saved.'
+    while SAVE_PIPELINE:
+        SAVE_PIPELINE.pop().close()
+
+
+@timed('save_image')
+def save_image(image, sequence=None, camera=None):
+    'Save an image to file after attempting rotation.'
+    if is_jpeg_frame(image):
+        return save_encoded_image(image.tobytes(), sequence, camera)
+    filename = image_filename(sequence, camera)
+    pipeline = get_save_pipeline()
+    if pipeline is None:
+        return _write_image(image, filename, camera)
+    pipeline.put(image, filename, camera)
+    verbose_log('Image queued for saving.')
+    prefix = '' if rotation_angle() is None else 'rotated_'
+    return upload_path(prefix + filename)
 
 
 def _get_usb_device_list():
@@ -272,6 +950,7 @@ def _get_usb_device_list():
     return device_list_str
 
 
+@timed('open_camera')
 def _open_camera(port):
     verbose_log('Opening camera...')
     try:
@@ -297,6 +976,8 @@ def _open_camera(port):
 
 
 def _adjust_settings(camera, image_width, image_height):
+    if MJPEG_ENABLED:
+        _request_mjpeg(camera)
     try:
         camera.set(cv2.CAP_PROP_FRAME_WIDTH, image_width)
         camera.set(cv2.CAP_PROP_FRAME_HEIGHT, image_height)
@@ -305,6 +986,51 @@ def _adjust_settings(camera, image_width, image_height):
         camera.set(cv2.cv.CV_CAP_PROP_FRAME_HEIGHT, image_height)
 
 
+def _request_mjpeg(camera):
+    'Ask the camera for undecoded MJPEG frames.'
+    try:
+        fourcc = cv2.VideoWriter_fourcc(*'MJPG')
+        camera.set(cv2.CAP_PROP_FOURCC, fourcc)
+        # only MJPEG frames can be kept undecoded, so check what was applied
+        if int(camera.get(cv2.CAP_PROP_FOURCC)) != fourcc:
+            verbose_log('MJPEG format not available. Using decoded frames.')
+            return
+        raw_set = camera.set(cv2.CAP_PROP_CONVERT_RGB, 0)
+    except AttributeError:
+        verbose_log('MJPEG capture not supported by this OpenCV version.')
+        return
+    verbose_log('MJPEG format requested (accepted, raw frames: {}).'.format(
+        bool(raw_set)))
+
+
+def is_jpeg_frame(frame):
+    'Check if a captured frame holds undecoded JPEG data.'
+    return (frame.dtype == np.uint8 and frame.ndim < 3 and frame.size > 2
+            and (frame.ndim == 1 or frame.shape[0] == 1)
+            and frame.flat[0] == 0xFF and frame.flat[1] == 0xD8)
+
+
+def jpeg_size(data):
+    'Read image width and height from JPEG data without decoding it.'
+    import struct
+    position = 2
+    while position + 9 < len(data):
+        marker, length = struct.unpack('>xBH', data[position:position + 4])
+        if 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+            height, width = struct.unpack(
+                '>HH', data[position + 5:position + 9])
+            return width, height
+        position += 2 + length
+    return None
+
+
+def frame_size(frame):
+    'Width and height of a captured frame.'
+    if is_jpeg_frame(frame):
+        return jpeg_size(frame.tobytes())
+    return frame.shape[1], frame.shape[0]
+
+
 def _check_camera_availability(camera_path):
     try:
         pids = subprocess.check_output(['fuser', camera_path])
@@ -318,13 +1044,17 @@ def _check_camera_availability(camera_path):
             subprocess.call(['kill', '-9', pid])
 
 
+@timed('capture')
 def _capture_usb_image(camera):
     try:
-        return camera.read()
+        ret, image = camera.read()
     except Exception as error:
         verbose_log(error)
         log('Image capture error.', 'error')
         return 0, None
+    if ret:
+        count('frames_captured')
+    return ret, image
 
 
 def _log_no_image():
@@ -332,15 +1062,124 @@ def _log_no_image():
     log('Problem getting image.', 'error')
 
 
-def usb_camera_photo():
-    'Take a photo using a USB camera.'
-    # Settings
+def _device_identity(camera_path):
+    'Device node details that change when a camera is reconnected.'
+    stat = os.stat(camera_path)
+    return [stat.st_ino, stat.st_rdev, int(stat.st_mtime)]
+
+
+def _usb_identity(camera_port):
+    'Describe the USB device behind a video port using sysfs.'
+    sysfs_path = '/sys/class/video4linux/video{}'.format(camera_port)
+    try:
+        with open(sysfs_path + '/name') as name_file:
+            name = name_file.read().strip()
+    except (IOError, OSError):
+        name = 'unknown'
+    return '{} ({})'.format(name, os.path.realpath(sysfs_path + '/device'))
+
+
+def _save_discovery_cache(camera_port, camera, frame, cached=None):
+    camera_path = '/dev/video' + str(camera_port)
+    size = '{}x{}'.format(WIDTH, HEIGHT)
+    try:
+        backend = camera.getBackendName()
+    except:
+        backend = None
+    if cached is None or cached.get('port') != camera_port:
+        cached = {'port': camera_port, 'path': camera_path,
+                  'usb': _usb_identity(camera_port), 'resolutions': {}}
+    cached['backend'] = backend
+    cached['resolutions'][size] = frame_size(frame)
+    path = cache_path('camera.json', IMAGES_DIR)
+    temp_path = '{}.{}.tmp'.format(path, os.getpid())
+    try:
+        cached['device'] = _device_identity(camera_path)
+        with open(temp_path, 'w') as cache_file:
+            json.dump(cached, cache_file)
+        os.rename(temp_path, path)
+    except (IOError, OSError):
+        verbose_log('Unable to save camera discovery cache.')
+
+
+def _open_cached_camera(image_width, image_height):
+    'Open the camera recorded by a previous discovery, if still present.'
+    try:
+        with open(cache_path('camera.json', IMAGES_DIR)) as cache_file:
+            cached = json.load(cache_file)
+        if _device_identity(cached['path']) != cached['device']:
+            verbose_log('Camera discovery cache out of date.')
+            return
+    except (IOError, OSError, ValueError, KeyError):
+        return
+    verbose_log('Opening cached camera {} ({} backend)...'.format(
+        cached['path'], cached['backend']))
+    api = getattr(cv2, 'CAP_{}'.format(cached['backend']), None)
+    try:
+        if api is None:
+            camera = cv2.VideoCapture(cached['port'])
+        else:
+            camera = cv2.VideoCapture(cached['port'], api)
+    except Exception as error:
+        verbose_log(error)
+        return
+    if not camera.isOpened():
+        camera.release()
+        verbose_log('Cached camera is not open.')
+        return
+    _adjust_settings(camera, image_width, image_height)
+    ret, frame = _capture_usb_image(camera)
+    if not ret:
+        camera.release()
+        verbose_log('Couldn\'t get frame from cached camera.')
+        return
+    verbose_log('First test frame captured.')
+    CAPTURE_DETAILS['port'] = cached['port']
+    if '{}x{}'.format(WIDTH, HEIGHT) not in cached['resolutions']:
+        _save_discovery_cache(cached['port'], camera, frame, cached)
+    return camera
+
+
+def _open_usb_port(camera_port, image_width, image_height):
+    'Open a video port and capture a test frame.'
+    camera_path = '/dev/video' + str(camera_port)
+    verbose_log('Trying {}'.format(camera_path))
+    if not os.path.exists(camera_path):
+        verbose_log('{} missing'.format(camera_path))
+        return None, None
+
+    # Close process using camera (if open)
+    _check_camera_availability(camera_path)
+
+    # Open the camera
+    camera = _open_camera(camera_port)
+    if camera is None:
+        return None, None
+
+    verbose_log('Adjusting image with test captures...')
+    # Set image size
+    _adjust_settings(camera, image_width, image_height)
+    # Capture test frame
+    ret, frame = _capture_usb_image(camera)
+    if not ret:
+        camera.release()
+        verbose_log('Couldn\'t get frame from {}'.format(camera_path))
+        return None, None
+    CAPTURE_DETAILS['port'] = camera_port
+    return camera, frame
+
+
+@timed('find_camera')
+def _find_usb_camera(image_width, image_height):
+    'Open the first video port that returns a test frame.'
     camera_port = 0      # default USB camera port
     max_port_num = 1     # highest port to try if not detected on port
-    discard_frames = 10  # number of frames to discard for auto-adjust
-    max_attempts = 5     # number of failed discard frames before quit
-    image_width = int(WIDTH)
-    image_height = int(HEIGHT)
+
+    # Try the camera found last time
+    if DISCOVERY_CACHE_ENABLED:
+        camera = _open_cached_camera(image_width, image_height)
+        if camera is not None:
+            return camera
 
     # Check USB devices for camera
     device_list_str = _get_usb_device_list()
@@ -353,41 +1192,129 @@ def usb_camera_photo():
         return
     max_port_num = len(video_ports) - 1
     verbose_log('Adjusting max port number to {}.'.format(max_port_num))
-    ret = False
+    camera = None
     while camera_port <= max_port_num:
-        camera_path = '/dev/video' + str(camera_port)
-        verbose_log('Trying {}'.format(camera_path))
-        if not os.path.exists(camera_path):
-            verbose_log('{} missing'.format(camera_path))
-            camera_port += 1
-            continue
-
-        # Close process using camera (if open)
-        _check_camera_availability(camera_path)
+        camera, frame = _open_usb_port(camera_port, image_width, image_height)
+        if camera is not None:
+            break
+        camera_port += 1
+    if camera is None:
+        _log_no_image()
+        return
+    verbose_log('First test frame captured.')
+    if DISCOVERY_CACHE_ENABLED:
+        _save_discovery_cache(camera_port, camera, frame)
+    return camera
 
-        # Open the camera
-        camera = _open_camera(camera_port)
-        if camera is None:
-            return
 
-        verbose_log('Adjusting image with test captures...')
-        # Set image size
-        _adjust_settings(camera, image_width, image_height)
-        # Capture test frame
-        ret, _ = _capture_usb_image(camera)
+def frame_statistics(frame):
+    'Mean luminance and luminance histogram of a downsampled frame.'
+    if is_jpeg_frame(frame):
+        small = cv2.imdecode(frame, cv2.IMREAD_REDUCED_GRAYSCALE_8)
+        if small is None:
+            return None
+        small = small.astype(np.float32)
+    else:
+        small = frame[::8, ::8].astype(np.float32)
+    if small.ndim == 3:
+        small = small.dot(np.array([0.114, 0.587, 0.299], np.float32))
+    bins = np.bincount((small // 16).astype(np.intp).ravel(), minlength=16)
+    return small.mean(), bins / float(small.size)
+
+
+def sharpness(frame):
+    'Variance of the Laplacian of a downsampled grayscale frame.'
+    if is_jpeg_frame(frame):
+        small = cv2.imdecode(frame, cv2.IMREAD_REDUCED_GRAYSCALE_4)
+        if small is None:
+            return None
+    else:
+        small = cv2.resize(frame, None, fx=0.25, fy=0.25,
+                           interpolation=cv2.INTER_AREA)
+        if small.ndim == 3:
+            small = cv2.cvtColor(small, cv2.COLOR_BGR2GRAY)
+    return cv2.Laplacian(small, cv2.CV_32F).var()
+
+
+@timed('capture_sharpest')
+def _capture_sharpest(camera):
+    'Capture frames and keep the sharpest if more than one is requested.'
+    frames = int(BEST_OF)
+    if frames <= 1:
+        return _capture_usb_image(camera)
+    best, best_index, scores = (0, None), None, []
+    for _ in range(frames):
+        ret, image = _capture_usb_image(camera)
         if not ret:
-            camera.release()
-            verbose_log('Couldn\'t get frame from {}'.format(camera_path))
-            camera_port += 1
             continue
-        break
-    if not ret:
-        _log_no_image()
+        score = sharpness(image)
+        if score is None:
+            verbose_log('Could not decode frame.')
+            continue
+        scores.append(round(float(score), 1))
+        if best_index is None or scores[-1] > scores[best_index]:
+            best, best_index = (ret, image), len(scores) - 1
+    if scores:
+        verbose_log('Sharpness scores: {}. Kept frame {}.'.format(
+            scores, best_index + 1))
+    return best
+
+
+def _frames_stable(previous, current):
+    max_luminance_change = 1.0  # out of 255
+    max_histogram_change = 0.02  # fraction of pixels changing bins
+    luminance_change = abs(current[0] - previous[0])
+    histogram_change = np.abs(current[1] - previous[1]).sum() / 2
+    return (luminance_change < max_luminance_change
+            and histogram_change < max_histogram_change)
+
+
+def _settle_camera_adaptively(camera):
+    'Read frames until brightness stops changing.'
+    max_frames = int(SETTLE_MAX_FRAMES)
+    stable_frames = 2  # consecutive stable frames required
+    max_attempts = 5   # number of failed frames before quit
+    settle_start = time()
+    previous = None
+    stable_count = 0
+    failed_attempts = 0
+    frame_count = 0
+    while frame_count < max_frames and failed_attempts < max_attempts:
+        ret, frame = camera.read()
+        if not ret:
+            verbose_log('Could not get frame.')
+            failed_attempts += 1
+            continue
+        current = frame_statistics(frame)
+        if current is None:
+            verbose_log('Could not decode frame.')
+            failed_attempts += 1
+            continue
+        frame_count += 1
+        count('settle_frames')
+        if previous is not None and _frames_stable(previous, current):
+            stable_count += 1
+        else:
+            stable_count = 0
+        previous = current
+        if stable_count >= stable_frames:
+            break
+    result = 'settled' if stable_count >= stable_frames else 'did not settle'
+    verbose_log('Camera {} after {} frames in {} seconds.'.format(
+        result, frame_count, round(time() - settle_start, 3)))
+
+
+@timed('settle')
+def _settle_camera(camera):
+    'Discard frames to let the camera auto-adjust.'
+    if SETTLE_MODE == 'adaptive':
+        _settle_camera_adaptively(camera)
         return
-    verbose_log('First test frame captured.')
-    # Let camera adjust
+    discard_frames = 10  # number of frames to discard for auto-adjust
+    max_attempts = 5     # number of failed discard frames before quit
     failed_attempts = 0
     for _ in range(discard_frames):
+        count('settle_frames')
         if not camera.grab():
             verbose_log('Could not get frame.')
             failed_attempts += 1
@@ -395,45 +1322,425 @@ def usb_camera_photo():
             break
         sleep(0.1)
 
-    # Take a photo
-    verbose_log('Taking photo...')
-    ret, image = _capture_usb_image(camera)
+
+@timed('usb_camera_photo')
+def usb_camera_photo():
+    'Take a photo using a USB camera.'
+    camera = _find_usb_camera(int(WIDTH), int(HEIGHT))
+    if camera is None:
+        return
+    # Let camera adjust
+    _settle_camera(camera)
+
+    # Take photos
+    _capture_burst(camera, int(BURST_COUNT), float(BURST_INTERVAL))
 
     # Close the camera
     camera.release()
 
-    # Output
-    if ret:  # an image has been returned by the camera
+
+def _capture_burst(camera, photos, interval):
+    'Take and save a sequence of photos from an open camera.'
+    burst_start = time()
+    for sequence in range(photos):
+        sleep(max(0, burst_start + sequence * interval - time()))
+        with capture_timings():
+            verbose_log('Taking photo...')
+            ret, image = _capture_sharpest(camera)
+            if not ret:  # no image has been returned by the camera
+                _log_no_image()
+                return
+            verbose_log('Photo captured.')
+            save_image(image, sequence if photos > 1 else None)
+
+
+def _run_threads(target, args_list):
+    'Call a function with each set of arguments on its own thread.'
+    threads = [threading.Thread(target=target, args=args) for args in args_list]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+def _synchronized_capture(cameras):
+    'Grab a frame from each camera at the same time and retrieve them.'
+    max_skew = float(MAX_CAMERA_SKEW)
+    max_attempts = 3
+    for attempt in range(max_attempts):
+        barrier = threading.Barrier(len(cameras))
+        grab_times = {}
+
+        def _grab(port, camera):
+            barrier.wait()
+            if camera.grab():
+                grab_times[port] = time()
+        _run_threads(_grab, cameras)
+        if not grab_times:
+            return []
+        skew = max(grab_times.values()) - min(grab_times.values())
+        verbose_log('Camera capture skew: {} seconds.'.format(round(skew, 4)))
+        if skew <= max_skew:
+            break
+        if attempt < max_attempts - 1:
+            verbose_log('Skew above {} seconds. Retrying...'.format(max_skew))
+    frames = []
+    for port, camera in cameras:
+        if port not in grab_times:
+            verbose_log('Could not get frame from /dev/video{}.'.format(port))
+            continue
+        ret, frame = camera.retrieve()
+        if ret:
+            count('frames_captured')
+            frames.append((port, frame))
+    return frames
+
+
+def usb_multi_camera_photo():
+    'Take photos with all USB cameras at the same time.'
+    image_width, image_height = int(WIDTH), int(HEIGHT)
+    video_ports = get_video_port_list()
+    verbose_log('{} video ports detected: {}'.format(
+        len(video_ports), ','.join(video_ports)))
+    ports = sorted(int(port[5:]) for port in video_ports if port[5:].isdigit())
+    opened = {}
+
+    def _open(port):
+        camera, _ = _open_usb_port(port, image_width, image_height)
+        if camera is not None:
+            opened[port] = camera
+    _run_threads(_open, [(port,) for port in ports])
+    cameras = sorted(opened.items())
+    if not cameras:
+        _log_no_image()
+        return
+    verbose_log('{} cameras opened: {}'.format(
+        len(cameras), ','.join('video{}'.format(port) for port, _ in cameras)))
+    _run_threads(_settle_camera, [(camera,) for _, camera in cameras])
+    verbose_log('Taking photos...')
+    frames = _synchronized_capture(cameras)
+    for _, camera in cameras:
+        camera.release()
+    if not frames:
+        _log_no_image()
+    for port, frame in frames:
+        with capture_timings():
+            save_image(frame, camera=port)
+
+
+class WarmCamera(object):
+    'Keep an open camera grabbing frames so exposure stays converged.'
+
+    def __init__(self, camera):
+        self.camera = camera
+        self.lock = threading.Lock()
+        self.running = True
+        self.thread = threading.Thread(target=self._grab_frames)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _grab_frames(self):
+        while self.running:
+            with self.lock:
+                grabbed = self.camera.grab()
+            sleep(0.001 if grabbed else 0.1)
+
+    def read(self):
+        'Capture the next frame.'
+        with self.lock:
+            return _capture_sharpest(self.camera)
+
+    def release(self):
+        'Stop grabbing frames and close the camera.'
+        self.running = False
+        self.thread.join()
+        self.camera.release()
+
+
+def _handle_daemon_request(connection, camera):
+    command = connection.recv(64).decode().strip()
+    if command == 'stop':
+        connection.sendall(b'stopping\n')
+        return False
+    saved_path = None
+    with capture_timings():
+        verbose_log('Taking photo...')
+        ret, image = camera.read()
+        if ret:
+            verbose_log('Photo captured.')
+            saved_path = save_image(image)
+        else:
+            _log_no_image()
+    connection.sendall((saved_path or '').encode() + b'\n')
+    return True
+
+
+def usb_camera_daemon(socket_path):
+    'Keep a USB camera open and take photos when requested over a socket.'
+    camera = _find_usb_camera(int(WIDTH), int(HEIGHT))
+    if camera is None:
+        return
+    _settle_camera(camera)
+    camera = WarmCamera(camera)
+    try:
+        os.remove(socket_path)
+    except OSError:
+        pass
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(socket_path)
+    server.listen(1)
+    verbose_log('Listening for photo requests on {}...'.format(socket_path))
+    try:
+        running = True
+        while running:
+            connection, _ = server.accept()
+            connection.settimeout(float(DAEMON_TIMEOUT))
+            try:
+                running = _handle_daemon_request(connection, camera)
+            except Exception as error:
+                verbose_log(error)
+                log('Capture daemon request error.', 'error')
+            finally:
+                connection.close()
+            write_capture_metrics()
+    finally:
+        server.close()
+        os.remove(socket_path)
+        camera.release()
+        verbose_log('Capture daemon stopped.')
+
+
+def in_timelapse_window():
+    'Check if the local time is within the time-lapse window, if one is set.'
+    if not TIMELAPSE_WINDOW:
+        return True
+    now = localtime()
+    minutes = now.tm_hour * 60 + now.tm_min
+    start, end = [int(t.split(':')[0]) * 60 + int(t.split(':')[1])
+                  for t in TIMELAPSE_WINDOW.split('-')]
+    if start <= end:
+        return start <= minutes < end
+    return minutes >= start or minutes < end  # overnight window
+
+
+def timelapse(capture):
+    'Call capture on a fixed schedule until the count or end time is reached.'
+    max_failures = 5  # number of consecutive failed captures before quit
+    interval = float(TIMELAPSE_INTERVAL)
+    total = int(TIMELAPSE_COUNT)
+    end = float(TIMELAPSE_END) if TIMELAPSE_END else None
+    # deadlines are on a monotonic grid so capture time never adds drift
+    start = monotonic()
+    clock_offset = time() - start
+    slot = photos = missed = failures = 0
+    max_lateness = 0
+    while not total or photos < total:
+        deadline = start + slot * interval
+        if end is not None and clock_offset + deadline > end:
+            break
+        lateness = monotonic() - deadline
+        if lateness >= interval:
+            skipped = int(lateness // interval)
+            verbose_log('Missed {} time-lapse deadlines.'.format(skipped))
+            count('timelapse_missed', skipped)
+            missed += skipped
+            slot += skipped
+            continue
+        sleep(max(0, -lateness))
+        slot += 1
+        if not in_timelapse_window():
+            continue
+        max_lateness = max(max_lateness, lateness)
+        record('timelapse_lateness', max(0, lateness))
+        with capture_timings():
+            captured = capture(photos)
+        write_capture_metrics()
+        if not captured:
+            count('timelapse_missed')
+            missed += 1
+            failures += 1
+            if failures >= max_failures:
+                verbose_log('Too many failed captures. Stopping time-lapse.')
+                break
+            continue
+        failures = 0
+        photos += 1
+    verbose_log('Time-lapse finished: {} photos, {} missed deadlines, '
+                'max lateness {} ms.'.format(
+                    photos, missed, round(max_lateness * 1000, 3)))
+
+
+def usb_camera_timelapse():
+    'Take photos on a schedule with a USB camera that stays open.'
+    camera = _find_usb_camera(int(WIDTH), int(HEIGHT))
+    if camera is None:
+        return
+    _settle_camera(camera)
+    camera = WarmCamera(camera)
+
+    def _capture(sequence):
+        verbose_log('Taking photo...')
+        ret, image = camera.read()
+        if not ret:
+            _log_no_image()
+            return False
         verbose_log('Photo captured.')
-        save_image(image)
-    else:  # no image has been returned by the camera
+        save_image(image, sequence)
+        return True
+
+    try:
+        timelapse(_capture)
+    finally:
+        camera.release()
+
+
+@timed('write_image')
+def write_image_data(filename_path, data, camera=None):
+    'Write encoded image data to file.'
+    if not write_file(filename_path, data):
+        return None
+    verbose_log('Image saved: {}'.format(filename_path))
+    count('images_saved')
+    index_image(filename_path, encoded_size(data), camera)
+    write_encoded_thumbnails(data, filename_path)
+    return filename_path
+
+
+@timed('lossless_rotate')
+def jpeg_quarter_turn(data, turns):
+    'Losslessly rotate JPEG data counterclockwise using jpegtran.'
+    if turns == 0:
+        return data
+    degrees = str(-90 * turns % 360)
+    args = ['jpegtran', '-rotate', degrees, '-perfect', '-copy', 'all']
+    verbose_log('Calling `{}`...'.format(' '.join(args)))
+    try:
+        return subprocess.check_output(args, input=data)
+    except (MissingError, subprocess.CalledProcessError):
+        verbose_log('Lossless rotation failed.')
+        return None
+
+
+def encoded_size(data):
+    'Width and height of encoded image data without decoding it.'
+    import struct
+    if encoded_format(data) == 'png':
+        return struct.unpack('>II', data[16:24])
+    if encoded_format(data) == 'jpg':
+        return jpeg_size(data)
+    return None
+
+
+def encoded_format(data):
+    'Detect the format of encoded image data.'
+    if data[:2] == b'\xff\xd8':
+        return 'jpg'
+    if data[:8] == b'\x89PNG\r\n\x1a\n':
+        return 'png'
+    return None
+
+
+def save_encoded_image(data, sequence=None, camera=None):
+    'Save encoded image data, decoding it only if required.'
+    filename = image_filename(sequence, camera)
+    data_format = encoded_format(data)
+    same_format = data_format == output_profile()['format']
+    angle = rotation_angle()
+    passthrough = not PROFILE_REPORT_ENABLED and region_of_interest() is None
+    if angle is None and same_format and passthrough:
+        verbose_log('Did not rotate image.')
+        return write_image_data(upload_path(filename), data, camera)
+    turns = None if angle is None else quarter_turns_only(angle)
+    lossless = LOSSLESS_ROTATION or LOW_MEMORY
+    if lossless and turns is not None and data_format == 'jpg' \
+            and same_format and passthrough:
+        rotated = jpeg_quarter_turn(data, turns)
+        if rotated:
+            verbose_log('Rotated image losslessly.')
+            return write_image_data(
+                upload_path('rotated_' + filename), rotated, camera)
+    image = cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_COLOR)
+    if image is None:
         _log_no_image()
+        return None
+    return save_image(image, sequence, camera)
+
+
+@timed('rpi_capture')
+def rpi_photo_data():
+    'Call raspistill and collect the JPEG data from stdout.'
+    args = rpi_photo_args('-')
+    std_print('Calling `{}`...'.format(' '.join(args)))
+    try:
+        return subprocess.check_output(args)
+    except (MissingError, subprocess.CalledProcessError):
+        return None
 
 
 def rpi_camera_photo():
     'Take a photo using the Raspberry Pi Camera.'
-    tempfile = upload_path('temporary')
-    verbose_log('Taking photo with Raspberry Pi camera...')
-    retcode = rpi_photo_call(tempfile)
-    if retcode == 0:
+    with capture_timings():
+        verbose_log('Taking photo with Raspberry Pi camera...')
+        data = rpi_photo_data()
+        if data:
+            verbose_log('Image captured.')
+            save_encoded_image(data)
+        else:
+            log('Raspberry Pi Camera not detected.', 'error')
+
+
+def rpi_camera_timelapse():
+    'Take photos on a schedule with the Raspberry Pi Camera.'
+    def _capture(sequence):
+        verbose_log('Taking photo with Raspberry Pi camera...')
+        data = rpi_photo_data()
+        if not data:
+            log('Raspberry Pi Camera not detected.', 'error')
+            return False
         verbose_log('Image captured.')
-        image = cv2.imread(tempfile)
-        os.remove(tempfile)
-        save_image(image)
-    else:
-        log('Raspberry Pi Camera not detected.', 'error')
+        save_encoded_image(data, sequence)
+        return True
+    timelapse(_capture)
 
 
 def take_photo():
     'Take a photo.'
-    CAMERA = get_camera_selection()
-
-    if 'NONE' in CAMERA:
-        log(CAMERA_DISABLED_MSG, 'error')
-    elif 'RPI' in CAMERA:
-        rpi_camera_photo()
-    else:
-        usb_camera_photo()
+    for metrics in METRICS.values():
+        metrics.clear()
+    CAPTURE_DETAILS.clear()
+    with timed('take_photo'):
+        CAMERA = get_camera_selection()
+        if PROFILE_NAME not in OUTPUT_PROFILES:
+            log('Unknown output profile: {}. Using default.'.format(
+                PROFILE_NAME), 'warn')
+        if ENCODER_NAME not in list(ENCODERS) + ['opencv', 'auto']:
+            log('Unknown encoder: {}. Using OpenCV.'.format(
+                ENCODER_NAME), 'warn')
+
+        if 'NONE' in CAMERA:
+            log(CAMERA_DISABLED_MSG, 'error')
+        elif 'RPI' in CAMERA:
+            if rotation_angle() is not None or opencv_required():
+                load_opencv()
+            if timelapse_enabled():
+                rpi_camera_timelapse()
+            else:
+                rpi_camera_photo()
+        elif daemon_enabled():
+            load_opencv()
+            usb_camera_daemon(DAEMON_SOCKET or '/tmp/take_photo.sock')
+        elif all_cameras_enabled():
+            load_opencv()
+            usb_multi_camera_photo()
+        elif timelapse_enabled():
+            load_opencv()
+            usb_camera_timelapse()
+        else:
+            load_opencv()
+            usb_camera_photo()
+        close_save_pipeline()
+    write_metrics()
+    LOG_DISPATCHER.flush()
 
 
 if __name__ == '__main__':
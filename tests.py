@@ -4,8 +4,14 @@
 
 import os
 import sys
+import json
+import shutil
+import socket
+import threading
+import time
 import unittest
 os.environ['take_photo_disable_rotation_adjustment'] = '0'
+import quick_photo
 import take_photo
 import numpy as np
 try:
@@ -57,14 +63,49 @@ ENVS = [
     'FARMWARE_TOKEN',
     'FARMWARE_API_V2_REQUEST_PIPE',
     'FARMWARE_API_V2_RESPONSE_PIPE',
+    'take_photo_daemon',
+    'take_photo_daemon_socket',
+    'take_photo_daemon_timeout',
+    'take_photo_burst',
+    'take_photo_burst_interval',
+    'take_photo_save_workers',
+    'take_photo_save_queue_size',
+    'take_photo_rotation_cache',
+    'take_photo_lossless_rotation',
+    'take_photo_discovery_cache',
+    'take_photo_settle',
+    'take_photo_settle_max_frames',
+    'take_photo_metrics',
+    'take_photo_all_cameras',
+    'take_photo_max_camera_skew',
+    'take_photo_mjpeg',
+    'take_photo_profile',
+    'take_photo_jpeg_quality',
+    'take_photo_profile_report',
+    'take_photo_thumbnails',
+    'take_photo_roi',
+    'take_photo_opencv_fallback',
+    'take_photo_low_memory',
+    'take_photo_timelapse_interval',
+    'take_photo_timelapse_count',
+    'take_photo_timelapse_end',
+    'take_photo_timelapse_window',
+    'take_photo_best_of',
+    'take_photo_quota_mb',
+    'take_photo_quota_keep_every',
+    'take_photo_index',
+    'take_photo_encoder',
 ]
+DAEMON_SOCKET = '/tmp/take_photo_test.sock'
 
 
 def re_import():
     try:
+        reload(quick_photo)
         reload(take_photo)
     except NameError:
         import importlib
+        importlib.reload(quick_photo)
         importlib.reload(take_photo)
 
 
@@ -84,15 +125,40 @@ def _prepare_fuser_mock(**kwargs):
     return _fuser_mock
 
 
+def _prepare_raspistill_mock(**kwargs):
+    def _raspistill_mock(args, **call_kwargs):
+        import subprocess
+        if args[0] == 'raspistill':
+            if kwargs.get('raspistill_error'):
+                raise subprocess.CalledProcessError(1, args)
+            image = np.zeros([16, 16, 3], np.uint8)
+            return cv2.imencode('.jpg', image)[1].tobytes()
+        if kwargs.get('jpegtran_error'):
+            raise subprocess.CalledProcessError(1, args)
+        return call_kwargs['input']
+    return _raspistill_mock
+
+
+def _jpeg_frame(width=16, height=8):
+    image = np.zeros([height, width, 3], np.uint8)
+    return cv2.imencode('.jpg', image)[1].reshape(1, -1)
+
+
 def _prepare_mock_capture(**kwargs):
-    def mocked_video_capture(*_args):
+    read_sequence = list(kwargs.get('read_sequence', []))
+
+    def mocked_video_capture(*args):
         'Used by mock.'
+        properties = {cv2.CAP_PROP_CONVERT_RGB: 1}
+
         class MockVideoCapture():
             'Mock cv2.VideoCapture'
 
             @staticmethod
             def isOpened():
                 'is camera open?'
+                if args and args[0] in kwargs.get('closed_ports', []):
+                    return False
                 ret = kwargs.get('isOpened')
                 return True if ret is None else ret
 
@@ -114,13 +180,28 @@ def _prepare_mock_capture(**kwargs):
                 'get image'
                 if kwargs.get('raise_read'):
                     raise NameError('mock error')
+                if read_sequence:
+                    return True, read_sequence.pop(0)
                 default_return = True, np.zeros([10, 10, 3], np.uint8)
                 return kwargs.get('read_return') or default_return
 
             @staticmethod
-            def set(*_args):
+            def retrieve():
+                'get grabbed image'
+                return MockVideoCapture.read()
+
+            @staticmethod
+            def set(prop, value):
                 'set parameter'
-                return
+                if prop == cv2.CAP_PROP_FOURCC and kwargs.get('reject_fourcc'):
+                    return False
+                properties[prop] = value
+                return True
+
+            @staticmethod
+            def get(prop):
+                'get parameter'
+                return properties.get(prop, 0)
 
             @staticmethod
             def release():
@@ -133,6 +214,39 @@ def _prepare_mock_capture(**kwargs):
     return mocked_video_capture
 
 
+def _prepare_encoder_modules():
+    import types
+    turbojpeg = types.ModuleType('turbojpeg')
+    turbojpeg.TJFLAG_PROGRESSIVE = 2
+
+    class TurboJPEG(object):
+        'Mock turbojpeg.TurboJPEG'
+
+        @staticmethod
+        def encode(image, quality, flags):
+            'encode image'
+            return 'turbojpeg {} {} {}'.format(
+                image.shape, quality, flags).encode()
+    turbojpeg.TurboJPEG = TurboJPEG
+
+    class PILImage(object):
+        'Mock PIL.Image.Image'
+
+        def __init__(self, image):
+            self.image = image
+
+        def save(self, output, **options):
+            'encode image'
+            if options['format'] == 'WEBP':
+                raise KeyError('WEBP')
+            output.write('pil {} {}'.format(
+                self.image[0, 0].tolist(), sorted(options.items())).encode())
+    pil_image = types.ModuleType('PIL.Image')
+    pil_image.fromarray = PILImage
+    return {'turbojpeg': turbojpeg, 'PIL': types.ModuleType('PIL'),
+            'PIL.Image': pil_image}
+
+
 def _prepare_mock_socket(**_kwargs):
     def mocked_socket(*_args):
         class MockSocket():
@@ -171,6 +285,16 @@ class TakePhotoTest(unittest.TestCase):
         self.assertLess(output.count('send_message'), 3)
         self.assertFalse('rotated' in output)
 
+    def test_import_times(self):
+        'Test heavy imports are deferred and timed.'
+        sys.modules.pop('requests', None)
+        re_import()
+        self.assertFalse('requests' in sys.modules)
+        take_photo.take_photo()
+        output = read_output_file(self.outfile)
+        self.assertTrue('import times (ms): {' in output)
+        self.assertFalse('requests' in sys.modules)
+
     def test_quiet(self):
         'Test quiet log level.'
         os.environ['take_photo_logging'] = 'quiet'
@@ -186,9 +310,52 @@ class TakePhotoTest(unittest.TestCase):
         take_photo.take_photo()
         output = read_output_file(self.outfile)
         self.assertFalse('[ ' in output)
+        self.assertLess(output.index('0 video ports detected'),
+                        output.index('usb camera not detected'))
         if FT_IMPORTED:
             self.assertGreater(output.count('send_message'), 3)
 
+    def test_log_dispatcher(self):
+        'Test log messages sent in the background drop oldest when full.'
+        re_import()
+        sent = []
+        sending = threading.Event()
+
+        def _slow_log(message, _message_type):
+            sending.wait()
+            sent.append(message)
+        with mock.patch('take_photo.send_log', _slow_log):
+            dispatcher = take_photo.LogDispatcher(2)
+            dispatcher.put('first', 'debug')
+            time.sleep(0.1)
+            for message in ['second', 'third', 'fourth']:
+                dispatcher.put(message, 'debug')
+            sending.set()
+            dispatcher.flush()
+        read_output_file(self.outfile)
+        self.assertEqual(sent, ['first', 'third', 'fourth',
+                                '1 debug log messages dropped.'])
+
+    def test_log_dispatcher_stalled(self):
+        'Test waiting for queued log messages gives up on a stalled log.'
+        re_import()
+        sending = threading.Event()
+
+        def _stalled_log(_message, _message_type):
+            sending.wait()
+        with mock.patch('take_photo.send_log', _stalled_log):
+            dispatcher = take_photo.LogDispatcher(10)
+            for message in ['first', 'second', 'third']:
+                dispatcher.put(message, 'debug')
+            start = time.time()
+            dispatcher.flush(0.2)
+            duration = time.time() - start
+            sending.set()
+        output = read_output_file(self.outfile)
+        self.assertGreaterEqual(duration, 0.2)
+        self.assertLess(duration, 5)
+        self.assertTrue('2 debug log messages dropped' in output)
+
     def test_timed_verbose(self):
         'Test timed verbose log level.'
         os.environ['take_photo_logging'] = 'verbose_timed'
@@ -200,8 +367,8 @@ class TakePhotoTest(unittest.TestCase):
             self.assertGreater(output.count('send_message'), 3)
 
     @unittest.skipIf(FT_IMPORTED, '')
-    @mock.patch('requests.post', mock.Mock())
-    def test_verbose_legacy(self):
+    @mock.patch('requests.Session')
+    def test_verbose_legacy(self, session):
         'Test verbose log level with legacy log.'
         os.environ['take_photo_logging'] = 'verbose'
         os.environ['FARMWARE_URL'] = 'url'
@@ -210,6 +377,8 @@ class TakePhotoTest(unittest.TestCase):
         take_photo.take_photo()
         output = read_output_file(self.outfile)
         self.assertFalse('[ ' in output)
+        self.assertEqual(session.call_count, 1)
+        self.assertGreater(session.return_value.post.call_count, 3)
 
     @mock.patch('os.listdir', mock.Mock(side_effect=lambda _: ['video0']))
     @mock.patch('os.path.exists', mock.Mock())
@@ -220,7 +389,7 @@ class TakePhotoTest(unittest.TestCase):
         re_import()
         take_photo.take_photo()
         output = read_output_file(self.outfile)
-        self.assertTrue('saved' in output)
+        self.assertTrue('image save error' in output)
         self.assertTrue('directory does not exist' in output)
 
     @mock.patch('os.listdir', mock.Mock(
@@ -347,6 +516,940 @@ class TakePhotoTest(unittest.TestCase):
         self.assertTrue('rotated' in output)
         self.assertFalse('directory does not exist' in output)
 
+    @mock.patch('os.listdir', mock.Mock(side_effect=lambda _: ['video0']))
+    @mock.patch('os.path.exists', mock.Mock())
+    @mock.patch('cv2.VideoCapture', _prepare_mock_capture())
+    def test_daemon(self):
+        'Test capture daemon.'
+        os.environ['take_photo_daemon'] = '1'
+        os.environ['take_photo_daemon_socket'] = DAEMON_SOCKET
+        re_import()
+        server = threading.Thread(target=take_photo.take_photo)
+        server.start()
+        saved_path = None
+        for _ in range(50):
+            saved_path = quick_photo.daemon_photo(DAEMON_SOCKET)
+            if saved_path is not None:
+                break
+            time.sleep(0.1)
+        stop_response = quick_photo.daemon_photo(DAEMON_SOCKET, 'stop')
+        server.join()
+        output = read_output_file(self.outfile)
+        self.assertTrue(saved_path.endswith('.jpg'))
+        self.assertEqual(stop_response, 'stopping')
+        self.assertTrue('listening' in output)
+        self.assertTrue('daemon stopped' in output)
+
+    @mock.patch('os.listdir', mock.Mock(side_effect=lambda _: ['video0']))
+    @mock.patch('os.path.exists', mock.Mock())
+    @mock.patch('cv2.VideoCapture', _prepare_mock_capture())
+    def test_daemon_bad_request(self):
+        'Test capture daemon keeps running after a failed request.'
+        os.environ['take_photo_daemon'] = '1'
+        os.environ['take_photo_daemon_socket'] = DAEMON_SOCKET
+        os.environ['take_photo_daemon_timeout'] = '0.5'
+        re_import()
+        server = threading.Thread(target=take_photo.take_photo)
+        server.start()
+        for _ in range(50):
+            if quick_photo.daemon_photo(DAEMON_SOCKET) is not None:
+                break
+            time.sleep(0.1)
+        client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        client.connect(DAEMON_SOCKET)
+        client.sendall(b'\xff\xfe\n')
+        client.recv(64)
+        client.close()
+        silent_client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        silent_client.settimeout(5)
+        silent_client.connect(DAEMON_SOCKET)
+        silent_response = silent_client.recv(64)
+        silent_client.close()
+        saved_path = quick_photo.daemon_photo(DAEMON_SOCKET)
+        with mock.patch('take_photo.write_file', return_value=False):
+            failed_path = quick_photo.daemon_photo(DAEMON_SOCKET)
+        stop_response = quick_photo.daemon_photo(DAEMON_SOCKET, 'stop')
+        server.join()
+        output = read_output_file(self.outfile)
+        self.assertEqual(silent_response, b'')
+        self.assertTrue(saved_path.endswith('.jpg'))
+        self.assertEqual(failed_path, '')
+        self.assertEqual(stop_response, 'stopping')
+        self.assertEqual(output.count('daemon request error'), 2)
+
+    def test_daemon_timeout(self):
+        'Test capture daemon client gives up on an unresponsive daemon.'
+        os.environ['take_photo_daemon_timeout'] = '0.2'
+        re_import()
+        try:
+            os.remove(DAEMON_SOCKET)
+        except OSError:
+            pass
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(DAEMON_SOCKET)
+        server.listen(1)
+        try:
+            self.assertIsNone(quick_photo.daemon_photo(DAEMON_SOCKET))
+        finally:
+            server.close()
+            os.remove(DAEMON_SOCKET)
+
+    @mock.patch('os.listdir', mock.Mock(side_effect=lambda _: ['video0']))
+    @mock.patch('os.path.exists', mock.Mock())
+    @mock.patch('cv2.VideoCapture', _prepare_mock_capture())
+    def test_burst(self):
+        'Test burst capture.'
+        os.environ['take_photo_burst'] = '3'
+        os.environ['take_photo_burst_interval'] = '0.01'
+        re_import()
+        take_photo.take_photo()
+        output = read_output_file(self.outfile)
+        self.assertEqual(output.count('photo captured'), 3)
+        self.assertTrue('_0.jpg' in output)
+        self.assertTrue('_2.jpg' in output)
+
+    @mock.patch('os.listdir', mock.Mock(side_effect=lambda _: ['video0']))
+    @mock.patch('os.path.exists', mock.Mock())
+    def test_timelapse(self):
+        'Test time-lapse capture with the camera kept open.'
+        os.environ['take_photo_timelapse_interval'] = '0.1'
+        os.environ['take_photo_timelapse_count'] = '3'
+        os.environ['take_photo_metrics'] = 'stdout'
+        re_import()
+        capture = mock.Mock(side_effect=_prepare_mock_capture())
+        with mock.patch('cv2.VideoCapture', capture):
+            start = time.time()
+            take_photo.take_photo()
+            duration = time.time() - start
+        output = read_output_file(self.outfile)
+        self.assertEqual(capture.call_count, 1)
+        self.assertEqual(output.count('photo captured'), 3)
+        self.assertTrue('_0.jpg' in output)
+        self.assertTrue('_2.jpg' in output)
+        lines = [json.loads(line) for line in output.strip().split('\n')
+                 if line.startswith('{')]
+        # one metrics line per capture, then one for the whole run
+        self.assertEqual(len(lines), 4)
+        missed = lines[-1]['counts'].get('timelapse_missed', 0)
+        self.assertTrue('time-lapse finished: 3 photos, {} missed'.format(
+            missed) in output)
+        for metrics in lines[:3]:
+            self.assertEqual(len(metrics['spans_ms']['save_image']), 1)
+        lateness = [metrics['spans_ms']['timelapse_lateness'][0]
+                    for metrics in lines[:3]]
+        self.assertFalse('timelapse_lateness' in lines[-1]['spans_ms'])
+        # deadlines at least one interval late are skipped instead
+        self.assertLessEqual(max(lateness), 100)
+        self.assertGreaterEqual(duration, 0.2 + 0.1 * missed)
+
+    @mock.patch('os.listdir', mock.Mock(side_effect=lambda _: ['video0']))
+    @mock.patch('os.path.exists', mock.Mock())
+    def test_best_of(self):
+        'Test the sharpest of several frames saved.'
+        os.environ['take_photo_best_of'] = '3'
+        re_import()
+        pattern = (np.indices([64, 64]) // 8).sum(axis=0) % 2 * 255
+        sharp = np.dstack([pattern] * 3).astype(np.uint8)
+        blurred = cv2.GaussianBlur(sharp, (0, 0), 4)
+        frames = [blurred, sharp, blurred]
+        capture = _prepare_mock_capture(read_sequence=[
+            np.zeros([64, 64, 3], np.uint8)] + frames)
+        with mock.patch('cv2.VideoCapture', capture):
+            with mock.patch('take_photo.write_image_file') as imwrite:
+                take_photo.take_photo()
+        output = read_output_file(self.outfile)
+        self.assertTrue('sharpness scores: [' in output)
+        self.assertTrue('kept frame 2.' in output)
+        self.assertTrue(imwrite.call_args[0][1] is sharp)
+        self.assertGreater(take_photo.sharpness(sharp),
+                           take_photo.sharpness(blurred))
+        self.assertGreater(take_photo.sharpness(_jpeg_frame(64, 64)), -1)
+
+    def _prepare_quota_images(self, images_dir):
+        shutil.rmtree(images_dir, ignore_errors=True)
+        os.mkdir(images_dir)
+        for i, name in enumerate('abcde'):
+            path = os.path.join(images_dir, name + '.jpg')
+            with open(path, 'wb') as image_file:
+                image_file.write(b'0' * 400)
+            os.utime(path, (1000 + i, 1000 + i))
+        try:
+            os.remove('/tmp/.take_photo_quota.json')
+        except OSError:
+            pass
+
+    def test_quota(self):
+        'Test oldest images removed to stay within the storage quota.'
+        images_dir = '/tmp/take_photo_test_quota'
+        self._prepare_quota_images(images_dir)
+        os.environ['IMAGES_DIR'] = images_dir
+        os.environ['take_photo_quota_mb'] = str(2097 / 1024. / 1024)
+        re_import()
+        self.assertTrue(take_photo.write_file(images_dir + '/f.jpg', b'1' * 600))
+        self.assertEqual(sorted(os.listdir(images_dir)),
+                         ['c.jpg', 'd.jpg', 'e.jpg', 'f.jpg'])
+        take_photo.save_quota_index()
+        take_photo.QUOTA_INDEX.clear()
+        take_photo.write_file(images_dir + '/g.jpg', b'1' * 600)
+        self.assertEqual(sorted(os.listdir(images_dir)),
+                         ['d.jpg', 'e.jpg', 'f.jpg', 'g.jpg'])
+        time.sleep(0.01)
+        os.remove(images_dir + '/e.jpg')
+        take_photo.write_file(images_dir + '/h.jpg', b'1' * 600)
+        self.assertEqual(sorted(os.listdir(images_dir)),
+                         ['f.jpg', 'g.jpg', 'h.jpg'])
+        self.assertFalse(take_photo.write_file('/tmp/missing/i.jpg', b'1'))
+        take_photo.save_quota_index()
+        with open('/tmp/.take_photo_quota.json') as index_file:
+            self.assertEqual(json.load(index_file)['used'], 1800)
+        take_photo.QUOTA_INDEX.clear()
+        shutil.rmtree(images_dir)
+        output = read_output_file(self.outfile)
+        self.assertEqual(output.count('scanning'), 2)
+        self.assertEqual(output.count('quota exceeded'), 4)
+        self.assertTrue('image save error' in output)
+
+    def test_quota_scans_once(self):
+        'Test the images directory is scanned once across several writes.'
+        images_dir = '/tmp/take_photo_test_quota'
+        self._prepare_quota_images(images_dir)
+        os.environ['IMAGES_DIR'] = images_dir
+        os.environ['take_photo_quota_mb'] = str(2097 / 1024. / 1024)
+        re_import()
+        with mock.patch('os.listdir', mock.Mock(wraps=os.listdir)) as listdir:
+            for name in 'fghijklmno':
+                take_photo.write_file(
+                    '{}/{}.jpg'.format(images_dir, name), b'1' * 600)
+        take_photo.QUOTA_INDEX.clear()
+        shutil.rmtree(images_dir)
+        output = read_output_file(self.outfile)
+        self.assertEqual(listdir.call_count, 1)
+        self.assertEqual(output.count('scanning'), 1)
+
+    def test_quota_keep_every(self):
+        'Test images thinned out to stay within the storage quota.'
+        images_dir = '/tmp/take_photo_test_quota'
+        self._prepare_quota_images(images_dir)
+        os.environ['IMAGES_DIR'] = images_dir
+        os.environ['take_photo_quota_mb'] = str(2097 / 1024. / 1024)
+        os.environ['take_photo_quota_keep_every'] = '2'
+        re_import()
+        take_photo.write_file(images_dir + '/f.jpg', b'1' * 600)
+        read_output_file(self.outfile)
+        self.assertEqual(sorted(os.listdir(images_dir)),
+                         ['a.jpg', 'c.jpg', 'e.jpg', 'f.jpg'])
+        take_photo.QUOTA_INDEX.clear()
+        shutil.rmtree(images_dir)
+
+    @mock.patch('os.listdir', mock.Mock(side_effect=lambda _: ['video0']))
+    @mock.patch('os.path.exists', mock.Mock())
+    @mock.patch('cv2.VideoCapture', _prepare_mock_capture())
+    def test_capture_index(self):
+        'Test unique filenames and capture index records.'
+        images_dir = '/tmp/take_photo_test_images'
+        index = '/tmp/.take_photo_index.jsonl'
+        try:
+            os.mkdir(images_dir)
+        except OSError:
+            pass
+        try:
+            os.remove(index)
+        except OSError:
+            pass
+        os.environ['IMAGES_DIR'] = images_dir
+        os.environ['take_photo_index'] = '1'
+        os.environ['CAMERA_CALIBRATION_total_rotation_angle'] = '90'
+        re_import()
+        with mock.patch('quick_photo.time', mock.Mock(return_value=1000.0)):
+            names = [take_photo.image_filename() for _ in range(3)]
+        self.assertEqual(names, ['1000000.jpg', '1000001.jpg', '1000002.jpg'])
+        take_photo.take_photo()
+        take_photo.take_photo()
+        with open(index) as index_file:
+            records = [json.loads(line) for line in index_file]
+        os.remove(index)
+        for record in records:
+            os.remove(record['file'])
+        read_output_file(self.outfile)
+        self.assertEqual(len(records), 2)
+        self.assertNotEqual(records[0]['file'], records[1]['file'])
+        self.assertEqual(records[0]['camera'], 'USB')
+        self.assertEqual(records[0]['port'], 0)
+        self.assertEqual([records[0]['width'], records[0]['height']], [10, 10])
+        self.assertEqual(records[0]['angle'], 90)
+        self.assertGreater(records[0]['bytes'], 0)
+        self.assertEqual(len(records[0]['spans_ms']['capture']), 1)
+        self.assertFalse('settle' in records[0]['spans_ms'])
+
+    @mock.patch('os.listdir', mock.Mock(side_effect=lambda _: ['video0']))
+    @mock.patch('os.path.exists', mock.Mock())
+    @mock.patch('cv2.VideoCapture', _prepare_mock_capture())
+    def test_capture_index_burst(self):
+        'Test capture index records hold the spans of their own capture.'
+        images_dir = '/tmp/take_photo_test_images'
+        index = '/tmp/.take_photo_index.jsonl'
+        try:
+            os.mkdir(images_dir)
+        except OSError:
+            pass
+        try:
+            os.remove(index)
+        except OSError:
+            pass
+        os.environ['IMAGES_DIR'] = images_dir
+        os.environ['take_photo_index'] = '1'
+        os.environ['take_photo_burst'] = '4'
+        re_import()
+        take_photo.take_photo()
+        with open(index) as index_file:
+            records = [json.loads(line) for line in index_file]
+        os.remove(index)
+        for record in records:
+            os.remove(record['file'])
+        read_output_file(self.outfile)
+        self.assertEqual(len(records), 4)
+        for record in records:
+            for stage in ['capture', 'save_image', 'write_image']:
+                self.assertEqual(len(record['spans_ms'][stage]), 1)
+
+    def test_encoders(self):
+        'Test selectable encoder backends.'
+        image = np.zeros([4, 6, 3], np.uint8)
+        image[:, :, 0] = 255
+        profile = {'format': 'jpg', 'quality': 75, 'progressive': True}
+        with mock.patch.dict(sys.modules, _prepare_encoder_modules()):
+            os.environ['take_photo_encoder'] = 'turbojpeg'
+            re_import()
+            self.assertEqual(take_photo.encode_image(image, profile, []),
+                             b'turbojpeg (4, 6, 3) 75 2')
+            os.environ['take_photo_encoder'] = 'pil'
+            re_import()
+            self.assertEqual(
+                take_photo.encode_image(image, profile, []),
+                b"pil [0, 0, 255] [('format', 'JPEG'), ('optimize', False), "
+                b"('progressive', True), ('quality', 75)]")
+            self.assertTrue(take_photo.encode_image(
+                image, {'format': 'png', 'compression': 1}, []).startswith(
+                    b"pil [0, 0, 255] [('compress_level', 1)"))
+            encoded = take_photo.encode_image(
+                image, {'format': 'webp', 'quality': 80}, [])
+            self.assertEqual(cv2.imdecode(encoded, 1).shape, (4, 6, 3))
+            self.assertTrue(take_photo.encode_image(
+                image, profile, []).startswith(b'pil'))
+            os.environ['take_photo_encoder'] = 'auto'
+            re_import()
+            self.assertTrue(take_photo.encode_image(
+                image, profile, []).startswith(b'turbojpeg'))
+            self.assertTrue(take_photo.encode_image(
+                image, {'format': 'png', 'compression': 1}, []).startswith(
+                    b'pil'))
+        output = read_output_file(self.outfile)
+        self.assertTrue("pil encoder failed ('webp')" in output)
+
+    def test_encoder_fallback(self):
+        'Test fallback to OpenCV when an encoder is not available.'
+        image = np.zeros([4, 6, 3], np.uint8)
+        os.environ['take_photo_encoder'] = 'turbojpeg'
+        re_import()
+        with mock.patch.dict(sys.modules, {'turbojpeg': None}):
+            for _ in range(2):
+                encoded = take_photo.encode_image(image, {'format': 'jpg'}, [])
+                self.assertEqual(cv2.imdecode(encoded, 1).shape, (4, 6, 3))
+        self.assertEqual(take_photo.encode_image(
+            image, {'format': 'png', 'compression': 1}, []).tobytes()[1:4],
+            b'PNG')
+        os.environ['take_photo_encoder'] = 'unknown'
+        os.environ['camera'] = 'none'
+        re_import()
+        take_photo.take_photo()
+        output = read_output_file(self.outfile)
+        self.assertEqual(output.count('turbojpeg encoder not available'), 1)
+        self.assertTrue('unknown encoder' in output)
+
+    @mock.patch('os.listdir', mock.Mock(side_effect=lambda _: ['video0']))
+    @mock.patch('os.path.exists', mock.Mock())
+    @mock.patch('cv2.VideoCapture', _prepare_mock_capture())
+    def test_encoder_save_image(self):
+        'Test saved images written with the selected encoder.'
+        os.environ['take_photo_encoder'] = 'turbojpeg'
+        os.environ['take_photo_metrics'] = 'stdout'
+        re_import()
+        with mock.patch.dict(sys.modules, _prepare_encoder_modules()):
+            with mock.patch('take_photo.write_file') as write_file:
+                take_photo.take_photo()
+        output = read_output_file(self.outfile)
+        self.assertEqual(write_file.call_args[0][1],
+                         b'turbojpeg (10, 10, 3) 95 0')
+        self.assertTrue('"turbojpeg_encodes": 1' in output)
+
+    def test_timelapse_missed_deadlines(self):
+        'Test time-lapse deadlines missed by a slow capture.'
+        os.environ['take_photo_timelapse_interval'] = '0.05'
+        os.environ['take_photo_timelapse_end'] = str(time.time() + 0.5)
+        re_import()
+        captures = []
+
+        def _slow_capture(sequence):
+            captures.append(sequence)
+            time.sleep(0.165 if sequence == 0 else 0)
+            return True
+
+        take_photo.timelapse(_slow_capture)
+        output = read_output_file(self.outfile)
+        missed = take_photo.METRICS['counts']['timelapse_missed']
+        self.assertTrue('time-lapse finished: {} photos, {} missed'.format(
+            len(captures), missed) in output)
+        # the first capture ends at least 0.115 s after the next deadline
+        self.assertGreaterEqual(missed, 2)
+        self.assertEqual(captures, list(range(len(captures))))
+        # one capture or missed deadline per slot until the end time
+        self.assertLessEqual(len(captures) + missed, 11)
+
+    def test_timelapse_failures(self):
+        'Test time-lapse continues after failed captures.'
+        os.environ['take_photo_timelapse_interval'] = '0.01'
+        os.environ['take_photo_timelapse_count'] = '3'
+        re_import()
+        results = [True, False, True, False, True]
+        capture = mock.Mock(side_effect=results)
+        take_photo.timelapse(capture)
+        self.assertEqual([call[0][0] for call in capture.call_args_list],
+                         [0, 1, 1, 2, 2])
+        missed = take_photo.METRICS['counts']['timelapse_missed']
+        self.assertGreaterEqual(missed, 2)
+        capture = mock.Mock(return_value=False)
+        take_photo.timelapse(capture)
+        output = read_output_file(self.outfile)
+        self.assertEqual(capture.call_count, 5)
+        self.assertTrue('too many failed captures' in output)
+
+    def test_timelapse_window(self):
+        'Test time-lapse photos skipped outside the window.'
+        now = time.localtime()
+        window_start = (now.tm_hour * 60 + now.tm_min + 120) % 1440
+        window_end = (window_start + 60) % 1440
+        os.environ['take_photo_timelapse_interval'] = '0.02'
+        os.environ['take_photo_timelapse_end'] = str(time.time() + 0.1)
+        os.environ['take_photo_timelapse_window'] = '{}:{:02}-{}:{:02}'.format(
+            window_start // 60, window_start % 60,
+            window_end // 60, window_end % 60)
+        re_import()
+        capture = mock.Mock(return_value=True)
+        take_photo.timelapse(capture)
+        self.assertFalse(capture.called)
+        os.environ['take_photo_timelapse_window'] = '{}:{:02}-{}:{:02}'.format(
+            window_end // 60, window_end % 60,
+            window_start // 60, window_start % 60)
+        re_import()
+        take_photo.timelapse(capture)
+        read_output_file(self.outfile)
+        self.assertTrue(capture.called)
+        self.assertEqual(capture.call_args_list[0][0], (0,))
+
+    @mock.patch('subprocess.check_output',
+                mock.Mock(side_effect=_prepare_raspistill_mock()))
+    def test_rpi_camera_timelapse(self):
+        'Test rpi camera time-lapse.'
+        os.environ['camera'] = 'rpi'
+        os.environ['take_photo_timelapse_interval'] = '0.01'
+        os.environ['take_photo_timelapse_count'] = '2'
+        re_import()
+        take_photo.take_photo()
+        output = read_output_file(self.outfile)
+        self.assertEqual(output.count('image captured'), 2)
+        self.assertTrue('_1.jpg' in output)
+
+    @mock.patch('os.listdir', mock.Mock(side_effect=lambda _: ['video0']))
+    @mock.patch('os.path.exists', mock.Mock())
+    @mock.patch('cv2.VideoCapture', _prepare_mock_capture())
+    def test_burst_save_pipeline(self):
+        'Test burst capture with images saved on worker threads.'
+        os.environ['take_photo_burst'] = '5'
+        os.environ['take_photo_save_workers'] = '2'
+        os.environ['take_photo_save_queue_size'] = '1'
+        os.environ['CAMERA_CALIBRATION_total_rotation_angle'] = '45'
+        re_import()
+        take_photo.take_photo()
+        output = read_output_file(self.outfile)
+        self.assertEqual(output.count('queued for saving'), 5)
+        self.assertEqual(output.count('image saved'), 5)
+        self.assertEqual(output.count('rotated image'), 5)
+        self.assertFalse(take_photo.SAVE_PIPELINE)
+
+    @mock.patch('os.listdir', mock.Mock(side_effect=lambda _: ['video0']))
+    @mock.patch('os.path.exists', mock.Mock())
+    @mock.patch('subprocess.call', mock.Mock(side_effect=lambda _: 0))
+    @mock.patch('cv2.VideoCapture', _prepare_mock_capture())
+    def test_quick_usb_camera_burst(self):
+        'Test burst capture skips quick capture.'
+        os.environ['take_photo_disable_rotation_adjustment'] = '1'
+        os.environ['take_photo_burst'] = '2'
+        re_import()
+        take_photo.take_photo()
+        output = read_output_file(self.outfile)
+        self.assertFalse('fswebcam' in output)
+        self.assertEqual(output.count('photo captured'), 2)
+
+    @mock.patch('os.listdir', mock.Mock(side_effect=lambda _: ['video0']))
+    @mock.patch('os.path.exists', mock.Mock())
+    @mock.patch('subprocess.call', mock.Mock(side_effect=lambda _: 0))
+    @mock.patch('cv2.VideoCapture', _prepare_mock_capture())
+    def test_quick_usb_camera_quota(self):
+        'Test storage quota skips quick capture.'
+        os.environ['take_photo_disable_rotation_adjustment'] = '1'
+        os.environ['take_photo_quota_mb'] = '100'
+        re_import()
+        with mock.patch('take_photo.write_file') as write_file:
+            take_photo.take_photo()
+        output = read_output_file(self.outfile)
+        self.assertFalse('fswebcam' in output)
+        self.assertTrue(write_file.called)
+
+    @mock.patch('os.listdir', mock.Mock(side_effect=lambda _: ['video0']))
+    @mock.patch('os.path.exists', mock.Mock())
+    @mock.patch('subprocess.call', mock.Mock(side_effect=lambda _: 0))
+    @mock.patch('cv2.VideoCapture', _prepare_mock_capture())
+    def test_quick_usb_camera_upload_profile(self):
+        'Test progressive upload profile skips quick capture.'
+        os.environ['take_photo_disable_rotation_adjustment'] = '1'
+        os.environ['take_photo_profile'] = 'upload'
+        re_import()
+        with mock.patch('take_photo.write_file') as write_file:
+            take_photo.take_photo()
+        output = read_output_file(self.outfile)
+        self.assertFalse('fswebcam' in output)
+        self.assertTrue(write_file.called)
+
+    @mock.patch('os.listdir', mock.Mock(side_effect=lambda _: ['video0']))
+    @mock.patch('os.path.exists', mock.Mock())
+    @mock.patch('cv2.VideoCapture', _prepare_mock_capture())
+    def test_discovery_cache(self):
+        'Test camera discovery cache.'
+        os.environ['IMAGES_DIR'] = '/tmp/take_photo_test_images'
+        os.environ['take_photo_discovery_cache'] = '1'
+        cache = '/tmp/.take_photo_camera.json'
+        try:
+            os.remove(cache)
+        except OSError:
+            pass
+        try:
+            os.mkdir('/tmp/take_photo_test_images')
+        except OSError:
+            pass
+        re_import()
+        with mock.patch('take_photo._device_identity', lambda _: [1, 2, 3]):
+            take_photo.take_photo()
+            with open(cache) as cache_file:
+                self.assertEqual(json.load(cache_file)['port'], 0)
+            take_photo.take_photo()
+        with mock.patch('take_photo._device_identity', lambda _: [4, 5, 6]):
+            take_photo.take_photo()
+        os.remove(cache)
+        output = read_output_file(self.outfile)
+        self.assertEqual(output.count('video ports detected'), 2)
+        self.assertEqual(output.count('opening cached camera /dev/video0'), 1)
+        self.assertEqual(output.count('cache out of date'), 1)
+        self.assertEqual(output.count('image saved'), 3)
+        self.assertFalse([name for name in os.listdir('/tmp')
+                          if name.startswith('.take_photo_camera.json.')])
+
+    def test_discovery_cache_camera_closed(self):
+        'Test cached camera released when it does not open.'
+        os.environ['IMAGES_DIR'] = '/tmp/take_photo_test_images'
+        cache = '/tmp/.take_photo_camera.json'
+        with open(cache, 'w') as cache_file:
+            json.dump({'port': 0, 'path': '/dev/video0', 'device': [1, 2, 3],
+                       'backend': 'V4L2'}, cache_file)
+        re_import()
+        camera = mock.Mock()
+        camera.isOpened.return_value = False
+        with mock.patch('take_photo._device_identity', lambda _: [1, 2, 3]):
+            with mock.patch('cv2.VideoCapture', return_value=camera):
+                self.assertIsNone(take_photo._open_cached_camera(640, 480))
+        os.remove(cache)
+        output = read_output_file(self.outfile)
+        self.assertTrue('cached camera is not open' in output)
+        self.assertTrue(camera.release.called)
+
+    @mock.patch('os.listdir', mock.Mock(side_effect=lambda _: ['video0']))
+    @mock.patch('os.path.exists', mock.Mock())
+    @mock.patch('cv2.VideoCapture', _prepare_mock_capture())
+    def test_adaptive_settle(self):
+        'Test adaptive camera settling.'
+        os.environ['take_photo_settle'] = 'adaptive'
+        re_import()
+        take_photo.take_photo()
+        output = read_output_file(self.outfile)
+        self.assertTrue('camera settled after 3 frames' in output)
+        self.assertTrue('image saved' in output)
+
+    @mock.patch('os.listdir', mock.Mock(side_effect=lambda _: ['video0']))
+    @mock.patch('os.path.exists', mock.Mock())
+    @mock.patch('cv2.VideoCapture', _prepare_mock_capture(
+        read_sequence=[np.full([10, 10, 3], 20 * i, np.uint8)
+                       for i in range(10)]))
+    def test_adaptive_settle_max_frames(self):
+        'Test adaptive camera settling frame limit.'
+        os.environ['take_photo_settle'] = 'adaptive'
+        os.environ['take_photo_settle_max_frames'] = '5'
+        re_import()
+        take_photo.take_photo()
+        output = read_output_file(self.outfile)
+        self.assertTrue('camera did not settle after 5 frames' in output)
+
+    @mock.patch('os.listdir', mock.Mock(side_effect=lambda _: ['video0']))
+    @mock.patch('os.path.exists', mock.Mock())
+    @mock.patch('cv2.VideoCapture', _prepare_mock_capture())
+    def test_metrics(self):
+        'Test JSON metrics output.'
+        metrics_path = '/tmp/take_photo_test_metrics.jsonl'
+        os.environ['take_photo_metrics'] = metrics_path
+        os.environ['CAMERA_CALIBRATION_total_rotation_angle'] = '45'
+        re_import()
+        take_photo.take_photo()
+        take_photo.take_photo()
+        read_output_file(self.outfile)
+        with open(metrics_path) as metrics_file:
+            records = [json.loads(line) for line in metrics_file]
+        os.remove(metrics_path)
+        self.assertEqual(len(records), 2)
+        spans = records[0]['spans_ms']
+        for stage in ['take_photo', 'usb_camera_photo', 'open_camera',
+                      'settle', 'rotate', 'write_image']:
+            self.assertEqual(len(spans[stage]), 1)
+        self.assertEqual(records[0]['counts']['settle_frames'], 10)
+        self.assertEqual(records[0]['counts']['images_saved'], 1)
+        self.assertEqual(records[1]['counts']['images_saved'], 1)
+
+    @mock.patch('os.listdir', mock.Mock(side_effect=lambda _: ['video0']))
+    @mock.patch('os.path.exists', mock.Mock())
+    @mock.patch('cv2.VideoCapture', _prepare_mock_capture())
+    def test_output_profile(self):
+        'Test output profile encoder parameters.'
+        os.environ['take_photo_profile'] = 'upload'
+        os.environ['take_photo_jpeg_quality'] = '60'
+        re_import()
+        with mock.patch('take_photo.write_image_file') as imwrite:
+            take_photo.take_photo()
+        read_output_file(self.outfile)
+        self.assertEqual(imwrite.call_args[0][2], [
+            cv2.IMWRITE_JPEG_QUALITY, 60,
+            cv2.IMWRITE_JPEG_OPTIMIZE, 1,
+            cv2.IMWRITE_JPEG_PROGRESSIVE, 1])
+
+    @mock.patch('os.listdir', mock.Mock(side_effect=lambda _: ['video0']))
+    @mock.patch('os.path.exists', mock.Mock())
+    @mock.patch('cv2.VideoCapture', _prepare_mock_capture())
+    def test_output_profile_unknown(self):
+        'Test unknown output profile.'
+        os.environ['take_photo_profile'] = 'unknown'
+        re_import()
+        take_photo.take_photo()
+        output = read_output_file(self.outfile)
+        self.assertTrue('unknown output profile' in output)
+        self.assertTrue('.jpg' in output)
+        self.assertEqual(take_photo.output_profile(), {'format': 'jpg'})
+
+    @mock.patch('os.listdir', mock.Mock(side_effect=lambda _: ['video0']))
+    @mock.patch('os.path.exists', mock.Mock())
+    @mock.patch('cv2.VideoCapture', _prepare_mock_capture())
+    def test_profile_report(self):
+        'Test output profile report.'
+        os.environ['take_photo_profile_report'] = '1'
+        os.environ['take_photo_metrics'] = 'stdout'
+        re_import()
+        take_photo.take_photo()
+        output = read_output_file(self.outfile)
+        for profile in take_photo.OUTPUT_PROFILES:
+            self.assertTrue('profile {}: '.format(profile) in output)
+        profiles = json.loads(output.strip().split('\n')[-1])['profiles']
+        self.assertEqual(profiles['default']['bytes'] > 0, True)
+
+    @mock.patch('os.listdir', mock.Mock(side_effect=lambda _: ['video0']))
+    @mock.patch('os.path.exists', mock.Mock())
+    def test_thumbnails(self):
+        'Test thumbnails written with the full size image.'
+        os.environ['take_photo_thumbnails'] = '4,x,8,20'
+        re_import()
+        capture = _prepare_mock_capture(
+            read_return=(True, np.zeros([6, 16, 3], np.uint8)))
+        with mock.patch('cv2.VideoCapture', capture):
+            with mock.patch('take_photo.write_image_file') as imwrite:
+                take_photo.take_photo()
+        output = read_output_file(self.outfile)
+        self.assertEqual(output.count('thumbnail saved'), 2)
+        paths = [call[0][0] for call in imwrite.call_args_list]
+        self.assertTrue(paths[1].endswith('_thumb8.jpg'))
+        self.assertTrue(paths[2].endswith('_thumb4.jpg'))
+        self.assertEqual(imwrite.call_args_list[1][0][1].shape, (3, 8, 3))
+        self.assertEqual(imwrite.call_args_list[2][0][1].shape, (2, 4, 3))
+
+    def test_metrics_stdout(self):
+        'Test JSON metrics output to stdout.'
+        os.environ['take_photo_metrics'] = 'stdout'
+        os.environ['camera'] = 'none'
+        re_import()
+        take_photo.take_photo()
+        output = read_output_file(self.outfile)
+        self.assertTrue('"spans_ms": {"take_photo": [' in output)
+        self.assertTrue('"peak_rss_kb": ' in output)
+
+    def test_benchmark(self):
+        'Test benchmark baseline comparison.'
+        import subprocess
+        baseline_path = '/tmp/take_photo_test_baseline.json'
+        args = [sys.executable, 'benchmark.py', '--stages', 'rotate',
+                '--sizes', '64x48', '--repeat', '1',
+                '--baseline', baseline_path]
+        subprocess.check_output(args + ['--save-baseline'])
+        output = subprocess.check_output(args).decode()
+        self.assertTrue('no regressions' in output.lower())
+        with open(baseline_path) as baseline_file:
+            baseline = json.load(baseline_file)
+        baseline[0]['allocated_peak_kb'] = 0
+        baseline[0]['wall_ms'] = 0
+        with open(baseline_path, 'w') as baseline_file:
+            json.dump(baseline, baseline_file)
+        with self.assertRaises(subprocess.CalledProcessError) as error:
+            subprocess.check_output(args)
+        os.remove(baseline_path)
+        read_output_file(self.outfile)
+        self.assertTrue(b'REGRESSION: rotate 64x48' in error.exception.output)
+
+    @mock.patch('os.listdir', mock.Mock(
+        side_effect=lambda _: ['video0', 'video1', 'video2', 'video3']))
+    @mock.patch('os.path.exists', mock.Mock())
+    @mock.patch('cv2.VideoCapture', _prepare_mock_capture(closed_ports=[1]))
+    def test_all_cameras(self):
+        'Test capture from all cameras.'
+        os.environ['take_photo_all_cameras'] = '1'
+        re_import()
+        take_photo.take_photo()
+        output = read_output_file(self.outfile)
+        self.assertTrue('3 cameras opened: video0,video2,video3' in output)
+        self.assertTrue('camera capture skew' in output)
+        for camera in [0, 2, 3]:
+            self.assertTrue('_camera{}.jpg'.format(camera) in output)
+        self.assertFalse('_camera1.jpg' in output)
+
+    @mock.patch('os.listdir', mock.Mock(side_effect=lambda _: ['video0']))
+    @mock.patch('os.path.exists', mock.Mock())
+    @mock.patch('cv2.VideoCapture', _prepare_mock_capture(grab_return=False))
+    def test_all_cameras_no_frame(self):
+        'Test capture from all cameras without a frame.'
+        os.environ['take_photo_all_cameras'] = '1'
+        re_import()
+        take_photo.take_photo()
+        output = read_output_file(self.outfile)
+        self.assertTrue('problem getting image' in output)
+        self.assertFalse('image saved' in output)
+
+    @mock.patch('os.listdir', mock.Mock(side_effect=lambda _: ['video0']))
+    @mock.patch('os.path.exists', mock.Mock())
+    def test_mjpeg(self):
+        'Test MJPEG frames written without decoding.'
+        os.environ['take_photo_mjpeg'] = '1'
+        os.environ['take_photo_settle'] = 'adaptive'
+        re_import()
+        capture = _prepare_mock_capture(read_return=(True, _jpeg_frame()))
+        with mock.patch('cv2.VideoCapture', capture):
+            with mock.patch('take_photo.write_image_file') as imwrite:
+                take_photo.take_photo()
+        output = read_output_file(self.outfile)
+        self.assertTrue('mjpeg format requested (accepted' in output)
+        self.assertTrue('camera settled' in output)
+        self.assertTrue('image saved' in output)
+        self.assertFalse(imwrite.called)
+        self.assertEqual(take_photo.jpeg_size(_jpeg_frame().tobytes()), (16, 8))
+
+    @mock.patch('os.listdir', mock.Mock(side_effect=lambda _: ['video0']))
+    @mock.patch('os.path.exists', mock.Mock())
+    def test_mjpeg_not_available(self):
+        'Test decoded frames kept when the camera rejects MJPEG.'
+        os.environ['take_photo_mjpeg'] = '1'
+        re_import()
+        capture = _prepare_mock_capture(reject_fourcc=True)
+        with mock.patch('cv2.VideoCapture', capture):
+            with mock.patch('take_photo.write_image_file') as imwrite:
+                take_photo.take_photo()
+        output = read_output_file(self.outfile)
+        self.assertTrue('mjpeg format not available' in output)
+        self.assertTrue(imwrite.called)
+        camera = capture(0)
+        take_photo._request_mjpeg(camera)
+        self.assertEqual(camera.get(cv2.CAP_PROP_CONVERT_RGB), 1)
+
+    @mock.patch('os.listdir', mock.Mock(side_effect=lambda _: ['video0']))
+    @mock.patch('os.path.exists', mock.Mock())
+    def test_mjpeg_rotated(self):
+        'Test MJPEG frames decoded for rotation.'
+        os.environ['take_photo_mjpeg'] = '1'
+        os.environ['CAMERA_CALIBRATION_total_rotation_angle'] = '45'
+        re_import()
+        capture = _prepare_mock_capture(read_return=(True, _jpeg_frame()))
+        with mock.patch('cv2.VideoCapture', capture):
+            take_photo.take_photo()
+        output = read_output_file(self.outfile)
+        self.assertTrue('rotated image' in output)
+        self.assertTrue('rotated_' in output)
+
+    @mock.patch('os.listdir', mock.Mock(side_effect=lambda _: ['video0']))
+    @mock.patch('os.path.exists', mock.Mock())
+    def test_mjpeg_corrupt(self):
+        'Test corrupt MJPEG frames reported instead of crashing.'
+        os.environ['take_photo_mjpeg'] = '1'
+        os.environ['take_photo_settle'] = 'adaptive'
+        os.environ['CAMERA_CALIBRATION_total_rotation_angle'] = '45'
+        re_import()
+        corrupt = np.frombuffer(b'\xff\xd8' + b'\x00' * 30, np.uint8)
+        capture = _prepare_mock_capture(read_return=(True, corrupt))
+        with mock.patch('cv2.VideoCapture', capture):
+            take_photo.take_photo()
+        output = read_output_file(self.outfile)
+        self.assertTrue('could not decode frame' in output)
+        self.assertTrue('camera did not settle' in output)
+        self.assertTrue('problem getting image' in output)
+        self.assertFalse('image saved' in output)
+        self.assertIsNone(take_photo.sharpness(corrupt))
+
+    def test_daemon_unavailable(self):
+        'Test capture daemon client fallback.'
+        os.environ['take_photo_daemon_socket'] = DAEMON_SOCKET
+        re_import()
+        output = read_output_file(self.outfile)
+        self.assertTrue('daemon not available' in output)
+
+    def test_rotation_matches_quarter_turns(self):
+        'Test single pass rotation matches quarter turns plus affine rotation.'
+        image = np.random.randint(0, 255, [48, 64, 3]).astype(np.uint8)
+        image = cv2.GaussianBlur(image, (0, 0), 3)
+        for angle in [-165, -90, 10, 75, 180]:
+            os.environ['CAMERA_CALIBRATION_total_rotation_angle'] = str(angle)
+            re_import()
+            turns, remaining = take_photo._quarter_turns(angle)
+            expected = np.rot90(image, k=turns)
+            height, width = expected.shape[:2]
+            matrix = cv2.getRotationMatrix2D(
+                (int(width / 2), int(height / 2)), remaining, 1)
+            expected = cv2.warpAffine(expected, matrix, (width, height))
+            rotated = take_photo.rotate(image)
+            self.assertEqual(rotated.shape, expected.shape)
+            difference = np.abs(rotated.astype(int) - expected.astype(int))
+            self.assertLessEqual(difference.max(), 1)
+
+    def test_rotation_cache(self):
+        'Test rotation lookup tables cached on disk.'
+        os.environ['IMAGES_DIR'] = '/tmp/take_photo_test_images'
+        os.environ['take_photo_rotation_cache'] = '1'
+        os.environ['CAMERA_CALIBRATION_total_rotation_angle'] = '75'
+        cache = '/tmp/.take_photo_rotation_maps.npz'
+        if os.path.exists(cache):
+            os.remove(cache)
+        image = np.zeros([48, 64, 3], np.uint8)
+        re_import()
+        self.assertEqual(take_photo.rotate(image).shape, (64, 48, 3))
+        self.assertTrue(os.path.exists(cache))
+        re_import()
+        take_photo.rotate(image)
+        os.environ['CAMERA_CALIBRATION_total_rotation_angle'] = '10'
+        re_import()
+        self.assertEqual(take_photo.rotate(image).shape, (48, 64, 3))
+        with open(cache, 'r+b') as cache_file:
+            cache_file.truncate(100)
+        re_import()
+        self.assertEqual(take_photo.rotate(image).shape, (48, 64, 3))
+        re_import()
+        take_photo.rotate(image)
+        os.remove(cache)
+        output = read_output_file(self.outfile)
+        self.assertEqual(output.count('building rotation maps'), 3)
+        self.assertEqual(output.count('loaded rotation maps'), 2)
+
+    def test_low_memory_rotation(self):
+        'Test low memory rotation matches and reuses output buffers.'
+        os.environ['IMAGES_DIR'] = '/tmp/take_photo_test_images'
+        image = np.random.randint(0, 255, [48, 64, 3]).astype(np.uint8)
+        for cached in ['0', '1']:
+            os.environ['take_photo_rotation_cache'] = cached
+            for angle in [10, 90, 180, 270]:
+                os.environ['CAMERA_CALIBRATION_total_rotation_angle'] = str(
+                    angle)
+                os.environ['take_photo_low_memory'] = '0'
+                re_import()
+                expected = take_photo.rotate(image)
+                os.environ['take_photo_low_memory'] = '1'
+                re_import()
+                source = image.copy()
+                rotated = take_photo.rotate(source)
+                self.assertTrue(np.array_equal(rotated, expected))
+                if angle == 180:
+                    self.assertTrue(rotated is source)
+                else:
+                    self.assertTrue(take_photo.rotate(source) is rotated)
+        try:
+            os.remove('/tmp/.take_photo_rotation_maps.npz')
+        except OSError:
+            pass
+
+    @mock.patch('subprocess.check_output',
+                mock.Mock(side_effect=_prepare_raspistill_mock()))
+    def test_rpi_camera_low_memory(self):
+        'Test rpi camera quarter turns without decoding in low memory mode.'
+        os.environ['camera'] = 'rpi'
+        os.environ['take_photo_low_memory'] = '1'
+        os.environ['CAMERA_CALIBRATION_total_rotation_angle'] = '-90'
+        re_import()
+        take_photo.take_photo()
+        output = read_output_file(self.outfile)
+        self.assertTrue('jpegtran -rotate 270' in output)
+        self.assertTrue('rotated image losslessly' in output)
+
+    def test_region_of_interest(self):
+        'Test region of interest warped without rotating the full image.'
+        os.environ['IMAGES_DIR'] = '/tmp/take_photo_test_images'
+        image = np.random.randint(0, 255, [48, 64, 3]).astype(np.uint8)
+        for cached in ['0', '1']:
+            os.environ['take_photo_rotation_cache'] = cached
+            for angle in [0, 10, 90, 180]:
+                os.environ['CAMERA_CALIBRATION_total_rotation_angle'] = str(
+                    angle)
+                os.environ['take_photo_roi'] = ''
+                re_import()
+                expected = take_photo.rotate(image)[5:25, 8:40]
+                os.environ['take_photo_roi'] = '8,5,32,20'
+                re_import()
+                with mock.patch('cv2.rotate') as quarter_turn:
+                    rotated = take_photo.rotate(image)
+                self.assertFalse(quarter_turn.called)
+                self.assertEqual(rotated.shape, (20, 32, 3))
+                difference = np.abs(rotated.astype(int) - expected.astype(int))
+                self.assertLessEqual(difference.max(), 1)
+        try:
+            os.remove('/tmp/.take_photo_rotation_maps.npz')
+        except OSError:
+            pass
+        os.environ['take_photo_roi'] = '40,30,100,100'
+        os.environ['take_photo_disable_rotation_adjustment'] = '1'
+        re_import()
+        self.assertEqual(take_photo.crop(image, take_photo.region_of_interest())
+                         .shape, (18, 24, 3))
+        os.environ['take_photo_roi'] = '1,2,3'
+        re_import()
+        self.assertEqual(take_photo.region_of_interest(), None)
+
+    @mock.patch('subprocess.check_output',
+                mock.Mock(side_effect=_prepare_raspistill_mock()))
+    def test_rpi_camera_region_of_interest(self):
+        'Test rpi camera capture decoded for a region of interest.'
+        os.environ['camera'] = 'rpi'
+        os.environ['take_photo_roi'] = '2,2,8,4'
+        re_import()
+        with mock.patch('take_photo.write_image_file') as imwrite:
+            take_photo.take_photo()
+        output = read_output_file(self.outfile)
+        self.assertTrue('image saved' in output)
+        self.assertEqual(imwrite.call_args[0][1].shape, (4, 8, 3))
+
     def test_none_camera(self):
         'Test none camera selection.'
         os.environ['camera'] = 'none'
@@ -392,10 +1495,8 @@ class TakePhotoTest(unittest.TestCase):
         self.assertTrue('-md 3' in output)
         self.assertFalse('-w' in output)
 
-    @mock.patch('cv2.imread', mock.Mock(side_effect=lambda _:
-                                        np.zeros([10, 10, 3], np.uint8)))
-    @mock.patch('os.remove', mock.Mock())
-    @mock.patch('subprocess.call', mock.Mock(side_effect=lambda _: 0))
+    @mock.patch('subprocess.check_output',
+                mock.Mock(side_effect=_prepare_raspistill_mock()))
     def test_rpi_camera_capture(self):
         'Test rpi camera capture success.'
         os.environ['camera'] = 'rpi'
@@ -403,9 +1504,84 @@ class TakePhotoTest(unittest.TestCase):
         take_photo.take_photo()
         output = read_output_file(self.outfile)
         self.assertTrue('raspberry pi' in output)
+        self.assertTrue('-o -' in output)
         self.assertTrue('image captured' in output)
+        self.assertTrue('image saved' in output)
+        self.assertFalse('rotated' in output)
 
-    @mock.patch('subprocess.call', mock.Mock(side_effect=lambda _: 1))
+    @mock.patch('subprocess.check_output',
+                mock.Mock(side_effect=_prepare_raspistill_mock()))
+    def test_rpi_camera_capture_rotated(self):
+        'Test rpi camera capture with rotation.'
+        os.environ['camera'] = 'rpi'
+        os.environ['CAMERA_CALIBRATION_total_rotation_angle'] = '45'
+        re_import()
+        take_photo.take_photo()
+        output = read_output_file(self.outfile)
+        self.assertTrue('image captured' in output)
+        self.assertTrue('rotated image' in output)
+        self.assertTrue('rotated_' in output)
+
+    @mock.patch('subprocess.check_output',
+                mock.Mock(side_effect=_prepare_raspistill_mock()))
+    def test_rpi_camera_lossless_rotation(self):
+        'Test rpi camera capture with lossless rotation.'
+        os.environ['camera'] = 'rpi'
+        os.environ['take_photo_lossless_rotation'] = '1'
+        os.environ['CAMERA_CALIBRATION_total_rotation_angle'] = '90'
+        re_import()
+        take_photo.take_photo()
+        output = read_output_file(self.outfile)
+        self.assertTrue('jpegtran -rotate 90' in output)
+        self.assertTrue('rotated image losslessly' in output)
+        self.assertTrue('rotated_' in output)
+
+    @mock.patch('subprocess.check_output', mock.Mock(
+        side_effect=_prepare_raspistill_mock(jpegtran_error=True)))
+    def test_rpi_camera_lossless_rotation_failure(self):
+        'Test rpi camera capture with lossless rotation failure.'
+        os.environ['camera'] = 'rpi'
+        os.environ['take_photo_lossless_rotation'] = '1'
+        os.environ['CAMERA_CALIBRATION_total_rotation_angle'] = '-180'
+        re_import()
+        take_photo.take_photo()
+        output = read_output_file(self.outfile)
+        self.assertTrue('jpegtran -rotate 180' in output)
+        self.assertTrue('lossless rotation failed' in output)
+        self.assertTrue('rotated image' in output)
+
+    @mock.patch('subprocess.check_output',
+                mock.Mock(side_effect=_prepare_raspistill_mock()))
+    def test_rpi_camera_capture_profile(self):
+        'Test rpi camera capture re-encoded for an output profile.'
+        os.environ['camera'] = 'rpi'
+        os.environ['take_photo_profile'] = 'webp'
+        re_import()
+        with mock.patch('take_photo.write_image_file') as imwrite:
+            take_photo.take_photo()
+        output = read_output_file(self.outfile)
+        self.assertTrue('image saved' in output)
+        self.assertTrue(imwrite.call_args[0][0].endswith('.webp'))
+        self.assertEqual(imwrite.call_args[0][2],
+                         [cv2.IMWRITE_WEBP_QUALITY, 80])
+
+    @mock.patch('subprocess.check_output',
+                mock.Mock(side_effect=_prepare_raspistill_mock()))
+    def test_rpi_camera_thumbnails(self):
+        'Test rpi camera thumbnails from a reduced size decode.'
+        os.environ['camera'] = 'rpi'
+        os.environ['take_photo_thumbnails'] = '4'
+        re_import()
+        with mock.patch('take_photo.write_image_file') as imwrite:
+            with mock.patch('cv2.imdecode', wraps=cv2.imdecode) as imdecode:
+                take_photo.take_photo()
+        output = read_output_file(self.outfile)
+        self.assertTrue('thumbnail saved' in output)
+        self.assertEqual(imdecode.call_args[0][1], cv2.IMREAD_REDUCED_COLOR_4)
+        self.assertTrue(imwrite.call_args[0][0].endswith('_thumb4.jpg'))
+
+    @mock.patch('subprocess.check_output', mock.Mock(
+        side_effect=_prepare_raspistill_mock(raspistill_error=True)))
     def test_rpi_camera_capture_failure(self):
         'Test rpi camera capture failure.'
         os.environ['camera'] = 'rpi'
@@ -474,6 +1650,40 @@ class TakePhotoTest(unittest.TestCase):
         self.assertTrue('brightness=100%' in output)
         self.assertFalse('no camera selected' in output)
 
+    @mock.patch('os.listdir', mock.Mock(side_effect=lambda _: ['video0']))
+    @mock.patch('subprocess.call', mock.Mock(side_effect=lambda _: 0))
+    def test_quick_usb_camera_profile(self):
+        'Test quick capture with usb camera and output profile.'
+        os.environ['take_photo_disable_rotation_adjustment'] = '1'
+        os.environ['take_photo_profile'] = 'png'
+        os.environ['camera'] = 'usb'
+        with self.assertRaises(SystemExit):
+            re_import()
+        output = read_output_file(self.outfile)
+        self.assertTrue('--png 1' in output)
+        self.assertTrue('.png' in output)
+
+    @mock.patch('os.listdir', mock.Mock(side_effect=lambda _: ['video0']))
+    @mock.patch('subprocess.call', mock.Mock(side_effect=lambda _: 0))
+    def test_quick_usb_camera_index(self):
+        'Test quick capture recorded in the capture index.'
+        os.environ['take_photo_disable_rotation_adjustment'] = '1'
+        os.environ['take_photo_index'] = '1'
+        index = '/tmp/.take_photo_index.jsonl'
+        try:
+            os.remove(index)
+        except OSError:
+            pass
+        with self.assertRaises(SystemExit):
+            re_import()
+        with open(index) as index_file:
+            record = json.loads(index_file.read())
+        os.remove(index)
+        read_output_file(self.outfile)
+        self.assertTrue(record['file'].startswith('/tmp/images/'))
+        self.assertEqual([record['width'], record['height']], [640, 480])
+        self.assertEqual(record['bytes'], None)
+
     @mock.patch('subprocess.call', mock.Mock(side_effect=lambda _: 0))
     @mock.patch('os.listdir', mock.Mock(side_effect=lambda _: []))
     def test_quick_usb_camera_missing_port(self):
@@ -514,6 +1724,25 @@ class TakePhotoTest(unittest.TestCase):
         self.assertFalse('fswebcam' in output)
         self.assertTrue('no camera selected' in output)
 
+    @unittest.skipIf(sys.version_info[0] < 3, '')
+    def test_log_batch(self):
+        'Test batched log messages reuse one connection.'
+        os.environ['FARMWARE_API_V2_REQUEST_PIPE'] = ''
+        os.environ['FARMWARE_API_V2_RESPONSE_PIPE'] = ''
+        re_import()
+        socket_mock = mock.Mock(side_effect=_prepare_mock_socket())
+        with mock.patch('socket.socket', socket_mock):
+            quick_photo._log('first message')
+            quick_photo._log('second message')
+            quick_photo.flush_log()
+            quick_photo._log('third message')
+            quick_photo.flush_log()
+        output = read_output_file(self.outfile)
+        self.assertEqual(socket_mock.call_count, 2)
+        self.assertEqual(output.count('rpc_request'), 2)
+        self.assertTrue('first message' in output.split('rpc_request')[1])
+        self.assertTrue('second message' in output.split('rpc_request')[1])
+
     def test_quick_none_camera_quiet(self):
         'Test quick capture with none camera selection: quiet.'
         os.environ['take_photo_disable_rotation_adjustment'] = '1'
@@ -524,11 +1753,71 @@ class TakePhotoTest(unittest.TestCase):
         output = read_output_file(self.outfile)
         self.assertFalse('no camera selected' in output)
 
+    def test_quick_photo_startup(self):
+        'Test quick photo module startup time without heavy imports.'
+        import subprocess
+        env = {'camera': 'none', 'PATH': os.getenv('PATH', '')}
+        check = ('import sys, quick_photo; '
+                 'print(sorted(set(sys.modules) & {"numpy", "cv2", "requests"}))')
+        imported = subprocess.check_output([sys.executable, '-c', check])
+        self.assertEqual(imported.decode().strip(), '[]')
+        start = time.time()
+        subprocess.check_output([sys.executable, '-c', 'pass'], env=env)
+        interpreter_time = time.time() - start
+        start = time.time()
+        output = subprocess.check_output(
+            [sys.executable, 'quick_photo.py'], env=env).decode().lower()
+        startup_time = time.time() - interpreter_time - start
+        start = time.time()
+        subprocess.check_output(
+            [sys.executable, '-c', 'import numpy, cv2'], env=env)
+        opencv_import_time = time.time() - interpreter_time - start
+        read_output_file(self.outfile)
+        self.assertTrue('no camera selected' in output)
+        self.assertLess(startup_time, opencv_import_time)
+
+    @mock.patch('os.listdir', mock.Mock(side_effect=lambda _: ['video0']))
+    @mock.patch('subprocess.call', mock.Mock(side_effect=lambda _: 1))
+    def test_quick_photo_failure(self):
+        'Test quick photo failure without OpenCV fallback.'
+        os.environ['take_photo_disable_rotation_adjustment'] = '1'
+        re_import()
+        with mock.patch('take_photo.take_photo') as opencv_photo:
+            with self.assertRaises(SystemExit):
+                quick_photo.main()
+        output = read_output_file(self.outfile)
+        self.assertTrue('fswebcam' in output)
+        self.assertTrue('image capture error' in output)
+        self.assertFalse(opencv_photo.called)
+
+    def test_quick_photo_opencv_required(self):
+        'Test quick photo with options requiring OpenCV.'
+        re_import()
+        with self.assertRaises(SystemExit):
+            quick_photo.main()
+        output = read_output_file(self.outfile)
+        self.assertTrue('require opencv' in output)
+
+    @mock.patch('os.listdir', mock.Mock(side_effect=lambda _: ['video0']))
+    @mock.patch('subprocess.call', mock.Mock(side_effect=lambda _: 1))
+    def test_quick_photo_opencv_fallback(self):
+        'Test quick photo failure with OpenCV fallback enabled.'
+        os.environ['take_photo_disable_rotation_adjustment'] = '1'
+        os.environ['take_photo_opencv_fallback'] = '1'
+        re_import()
+        with mock.patch('take_photo.take_photo') as opencv_photo:
+            quick_photo.main()
+        output = read_output_file(self.outfile)
+        self.assertTrue('trying opencv' in output)
+        self.assertTrue(opencv_photo.called)
+        self.assertEqual(quick_photo.FALLBACK, [True])
+
     @unittest.skipIf(CV2_IMPORTED, '')
     def test_opencv_missing(self):
         'Test for cv2 import error.'
+        re_import()
         with self.assertRaises(SystemExit):
-            re_import()
+            take_photo.take_photo()
         output = read_output_file(self.outfile)
         self.assertTrue('import error' in output)
 